@@ -0,0 +1,40 @@
+from scdb import Database, Table, StringField, IntegerField, ForeignKeyField, ManyToManyField
+
+class User(Table):
+    id = IntegerField(primary_key=True)
+    username = StringField()
+
+class Group(Table):
+    id = IntegerField(primary_key=True)
+    host = ForeignKeyField(to=User)
+    members = ManyToManyField(to=User)
+
+db = Database()
+db.add_table(User)
+db.add_table(Group)
+
+db.add_records("User", [User(id=1, username="host"), User(id=2, username="member"), User(id=3, username="other")])
+db.add_records("Group", [Group(id=1, host=1, members=[1, 2]), Group(id=2, host=3, members=[3])])
+
+db.delete("User", 2) # only in a members list, so it just gets taken out of it
+print(db.get("Group", id=1))
+
+try:
+    db.delete("User", 1) # group 1 still has them as host
+except ValueError as err:
+    print(err)
+
+db.delete("User", 1, on_delete="set_null")
+print(db.get("Group", id=1))
+
+print(db.delete_where("User", username="other", on_delete="cascade")) # takes group 2 with it
+print(db.all("Group"))
+print(db.relations)
+
+## Output:
+# > Group(id = 1, host = 1, members = [1])
+# > Can't delete User 1, Group.host still points at it (use on_delete='cascade' or 'set_null')
+# > Group(id = 1, host = None, members = [])
+# > 1
+# > [Group(id = 1, host = None, members = [])]
+# > {'Group_User': {1: []}}
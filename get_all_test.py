@@ -20,7 +20,11 @@ print(db.get("User", id=3)) # if no matching object exists, then None is returne
 print(db.all("User")) # Returns a list always
 print(db.get("User", name="Bob"))
 
+adults = db.find("User", age=30) # lazy, nothing is scanned until it's used
+print(adults.count(), adults.first())
+
 ## Output:
 # > User: id = 1, name = Alice, age = 25
 # > [User(id=1, name=Alice, age=25), User(id=2, name=Bob, age=30)]
-# > User: id = 2, name = Bob, age = 30
\ No newline at end of file
+# > User: id = 2, name = Bob, age = 30
+# > 1 User: id = 2, name = Bob, age = 30
\ No newline at end of file
@@ -0,0 +1,38 @@
+from scdb import Database, Table, StringField, IntegerField
+
+class Post(Table):
+    id = IntegerField(primary_key=True, range_index=True) # primary keys (and unique fields) are always indexed
+    title = StringField(index=True)
+    author = IntegerField()
+    category = IntegerField()
+
+    class Meta:
+        indexes = ["author", "category"]
+
+db = Database()
+db.add_table(Post)
+
+for i in range(1, 10001):
+    db.add_record("Post", Post(id=i, title=f"Post {i % 100}", author=i % 50, category=i % 3))
+
+print(db.get("Post", id=42)) # straight from the primary key index
+print(len(db.get("Post", title="Post 7", author=7))) # starts from whichever index matches the fewest posts
+
+post = db.get("Post", id=1)
+post.title = "Renamed"
+print(db.get("Post", title="Renamed")) # indexes follow assignments
+
+print([p.id for p in db.range("Post", "id", 1000, 1004)]) # bisects the sorted index instead of scanning
+print(db.order_by("Post", "id", descending=True)[0])
+
+db.save_to_file("testdata/indexes.scdb", "bin")
+loaded_db = Database.load_from_file("testdata/indexes.scdb")
+print(loaded_db.tables["Post"]._indexed) # secondary indexes are stored in the schema
+
+## Output:
+# > Post(id = 42, title = Post 42, author = 42, category = 0)
+# > 100
+# > Post(id = 1, title = Renamed, author = 1, category = 1)
+# > [1000, 1001, 1002, 1003, 1004]
+# > Post(id = 10000, title = Post 0, author = 0, category = 1)
+# > ('id', 'title', 'author', 'category')
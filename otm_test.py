@@ -45,4 +45,12 @@ print(loaded_tbl)
 
 print(new_db.get("User", id=1))
 
+# resolve the ids to records for every group at once
+for group, host in new_db.join("Group", "host"):
+    print(group.name, "is hosted by", host.username)
+print(new_db.query('get: {name} from Group include: {members}').first())
+
+# and the other way around, everything that points at user 2 (host, members, ...)
+print(new_db.referrers("User", 2))
+
 new_db.run_admin_panel(save_path="testdata/otm.scdb")
\ No newline at end of file
@@ -0,0 +1,42 @@
+from scdb import Database, Table, StringField, IntegerField
+
+class User(Table):
+    id = IntegerField(primary_key=True)
+    username = StringField()
+    age = IntegerField()
+
+class Post(Table):
+    id = IntegerField(primary_key=True)
+    title = StringField()
+
+db = Database()
+db.add_table(User)
+db.add_table(Post)
+db.add_records("User", [User(id=i, username=f"user{i}", age=20 + i) for i in range(1, 21)])
+db.add_records("Post", [Post(id=1, title="hello")])
+db.save_to_file("testdata/scan.scdb", "bin")
+
+print(Database.table_counts("testdata/scan.scdb")) # only reads the footer
+
+# no tables at all, the footer comes right after the schema
+Database().save_to_file("testdata/empty.scdb", "bin")
+print(Database.table_counts("testdata/empty.scdb"), Database.load_from_file("testdata/empty.scdb").tables)
+
+# just the Post table, User is never decoded
+print(Database.load_from_file("testdata/scan.scdb", tables=["Post"]).all("Post"))
+
+# just the usernames (+ the pk)
+print(Database.load_from_file("testdata/scan.scdb", fields={"User": ["username"]}).get("User", id=3))
+
+# straight off the file, only rows matching the where get made into records
+for user in Database.scan_file("testdata/scan.scdb", "User", 'age >= &("age")', age=38):
+    print(user)
+
+## Output:
+# > {'User': 20, 'Post': 1}
+# > {} {}
+# > [Post(id = 1, title = hello)]
+# > User(id = 3, username = user3)
+# > User(id = 18, username = user18, age = 38)
+# > User(id = 19, username = user19, age = 39)
+# > User(id = 20, username = user20, age = 40)
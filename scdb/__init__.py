@@ -3,14 +3,48 @@
 ## LICENSE: MIT
 
 
+import io
 import os
 import json
 import enum
+import mmap
+import zlib
+import struct
+import threading
+import weakref
+from array import array
+from itertools import islice
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from bisect import bisect_left, bisect_right
 from cryptography.fernet import Fernet
-from typing import Any, Dict, List, Optional, Type, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Type, Union
 from datetime import date, time, datetime
 from flask import Flask, request, redirect, url_for, render_template, jsonify
 
+## binary format versions:
+## 1 - no header, every record stores its field count + each field name next to the value
+## 2 - b'SCDB' + version byte, field attributes in the schema, positional records
+##     and each table's data block is length prefixed
+## 3 - same as 2 with a footer at the end: a directory of every table's block
+##     (offset, length, record count) + where the schema starts, then the footer's
+##     own offset and b'SCDB' again as the last 12 bytes, so tables can be found without
+##     walking past every block in front of them
+_MAGIC = b'SCDB'
+_FORMAT_VERSION = 3
+
+# precompiled struct formats for the binary format
+_U32 = struct.Struct('!I')
+_U64 = struct.Struct('!Q')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+_DATE = struct.Struct('!III')
+_TIME = struct.Struct('!III')
+_DATETIME = struct.Struct('!IIIIII')
+
+# how many parsed + planned SCQL statements a database keeps around
+_PLAN_CACHE_SIZE = 128
+
 class RelationType(enum.Enum):
     ONE_TO_ONE = "OneToOne"
     ONE_TO_MANY = "OneToMany"
@@ -59,6 +93,8 @@ class Field:
         self.blank = kwargs.get('blank', False)
         self.default = kwargs.get('default', None)
         self.unique = kwargs.get('unique', False)
+        self.index = kwargs.get('index', False)
+        self.range_index = kwargs.get('range_index', False)
 
     def to_dict(self):
         return {
@@ -78,6 +114,62 @@ class Field:
                 raise TypeError(f"Expected {self.field_type.__name__}, got {type(value).__name__}")
         return value
 
+    ## _compile returns a function doing exactly what validate() does, but with the
+    ## attributes already looked up, TableMeta builds these once per table class.
+    ## a subclass overriding validate() without its own _compile just gets validate back
+    ## (so changing a field's attributes after the table class exists isnt picked up)
+    def _compile(self):
+        if type(self).validate is not Field.validate:
+            return self.validate
+        return self._type_check()
+
+    def _type_check(self):
+        null = self.null
+        field_type = self.field_type
+
+        def check(value):
+            if value is None:
+                if not null:
+                    raise ValueError(f"Field cannot be null")
+                return value
+            if isinstance(value, field_type):
+                return value
+            try:
+                return field_type(value)
+            except:
+                raise TypeError(f"Expected {field_type.__name__}, got {type(value).__name__}")
+        return check
+
+    def _range_check(self):
+        type_check = self._type_check()
+        min_value = self.min_value
+        max_value = self.max_value
+
+        def check(value):
+            value = type_check(value)
+            if value is not None:
+                if min_value is not None and value < min_value:
+                    raise ValueError(f"Value {value} is less than minimum {min_value}")
+                if max_value is not None and value > max_value:
+                    raise ValueError(f"Value {value} is greater than maximum {max_value}")
+            return value
+        return check
+
+    def _iso_check(self, parse):
+        # date/time/datetime, same fallback to fromisoformat as their validate()
+        type_check = self._type_check()
+        field_type = self.field_type
+
+        def check(value):
+            value = type_check(value)
+            if value is not None and not isinstance(value, field_type):
+                try:
+                    return parse(value)
+                except ValueError:
+                    raise ValueError(f"Invalid {field_type.__name__} format: {value}")
+            return value
+        return check
+
 class StringField(Field):
     def __init__(self, max_length: int = 255, **kwargs):
         super().__init__(str, max_length=max_length, **kwargs)
@@ -97,6 +189,11 @@ class IntegerField(Field):
                 raise ValueError(f"Value {value} is greater than maximum {self.max_value}")
         return value
 
+    def _compile(self):
+        if type(self).validate is not IntegerField.validate:
+            return self.validate
+        return self._range_check()
+
 class FloatField(Field):
     def __init__(self, **kwargs):
         super().__init__(float, **kwargs)
@@ -112,6 +209,11 @@ class FloatField(Field):
                 raise ValueError(f"Value {value} is greater than maximum {self.max_value}")
         return value
 
+    def _compile(self):
+        if type(self).validate is not FloatField.validate:
+            return self.validate
+        return self._range_check()
+
 class ArrayField(Field):
     def __init__(self, item_type: Type, max_length: int = None, **kwargs):
         super().__init__(list, **kwargs)
@@ -137,6 +239,24 @@ class ArrayField(Field):
                     raise TypeError(f"Expected {self.item_type.__name__}, got {type(item).__name__}")
         return value
 
+    def _compile(self):
+        if type(self).validate is not ArrayField.validate:
+            return self.validate
+        type_check = self._type_check()
+        item_type = self.item_type
+        max_length = self.max_length
+
+        def check(value):
+            value = type_check(value)
+            if value is not None:
+                if max_length is not None and len(value) > max_length:
+                    raise ValueError(f"Array length {len(value)} is too high. ({len(value)} / {max_length}")
+                for item in value:
+                    if not isinstance(item, item_type):
+                        raise TypeError(f"Expected {item_type.__name__}, got {type(item).__name__}")
+            return value
+        return check
+
 class DateField(Field):
     def __init__(self, **kwargs):
         super().__init__(date, **kwargs)
@@ -150,6 +270,11 @@ class DateField(Field):
                 raise ValueError(f"Invalid date format: {value}")
         return value
 
+    def _compile(self):
+        if type(self).validate is not DateField.validate:
+            return self.validate
+        return self._iso_check(date.fromisoformat)
+
 class TimeField(Field):
     def __init__(self, **kwargs):
         super().__init__(time, **kwargs)
@@ -163,6 +288,11 @@ class TimeField(Field):
                 raise ValueError(f"Invalid time format: {value}")
         return value
 
+    def _compile(self):
+        if type(self).validate is not TimeField.validate:
+            return self.validate
+        return self._iso_check(time.fromisoformat)
+
 class DateTimeField(Field):
     def __init__(self, **kwargs):
         super().__init__(datetime, **kwargs)
@@ -176,6 +306,11 @@ class DateTimeField(Field):
                 raise ValueError(f"Invalid datetime format: {value}")
         return value
 
+    def _compile(self):
+        if type(self).validate is not DateTimeField.validate:
+            return self.validate
+        return self._iso_check(datetime.fromisoformat)
+
 class BooleanField(Field):
     def __init__(self, **kwargs):
         super().__init__(bool, **kwargs)
@@ -187,6 +322,18 @@ class RelationField(Field):
         self.to = to
         self.relation_type = relation_type
 
+    def validate(self, value):
+        # tables loaded from a file only know the related table by name
+        if isinstance(self.field_type, str):
+            if value is None:
+                if not self.null:
+                    raise ValueError(f"Field cannot be null")
+                return value
+            if not isinstance(value, Table) or value.__class__.__name__ != self.field_type:
+                raise TypeError(f"Expected {self.field_type}, got {type(value).__name__}")
+            return value
+        return super().validate(value)
+
     def to_dict(self):
         base_dict = super().to_dict()
         base_dict["to"] = self.to if isinstance(self.to, str) else self.to.__name__
@@ -246,34 +393,113 @@ class EnumField(Field):
             raise ValueError(f"Value {value} is not a valid member of enum {self.enum.name}")
         return value
 
+    def _compile(self):
+        if type(self).validate is not EnumField.validate:
+            return self.validate
+        type_check = self._type_check()
+        enum = self.enum
+
+        def check(value):
+            value = type_check(value)
+            if value is not None and value not in enum.values.values():
+                raise ValueError(f"Value {value} is not a valid member of enum {enum.name}")
+            return value
+        return check
+
+def _field_attributes(field: Field) -> Dict[str, Any]:
+    # only the plain json-able attributes, anything else (types, enums, tables)
+    # is either written separately in the schema or cant be stored
+    return {key: value for key, value in field.attributes.items() if isinstance(value, (str, int, float, bool)) or value is None}
+
 class TableMeta(type):
     def __new__(cls, name, bases, attrs):
         fields = {}
-        for key, value in attrs.items():
-            if isinstance(value, Field):
-                fields[key] = value
-                attrs[key] = None
+        for base in reversed(bases):
+            fields.update(getattr(base, '_fields', {}))
+        own_fields = [key for key, value in attrs.items() if isinstance(value, Field)]
+        for key in own_fields:
+            fields[key] = attrs.pop(key)
+        # records only ever hold their field values, so no per-instance __dict__
+        attrs.setdefault('__slots__', tuple(own_fields))
         attrs['_fields'] = fields
+        # first declared primary key, otherwise fall back to `id` since thats what
+        # everything (relations, the admin panel) keys records by anyway
+        attrs['_pk'] = next((key for key, field in fields.items() if field.primary_key), 'id' if 'id' in fields else None)
+        ## fields Database keeps a hash index on: primary keys, unique fields, the pk fallback above
+        ## and secondary indexes declared with index=True or listed in an inner `class Meta: indexes = [...]`
+        indexed = []
+        for base in bases:
+            indexed.extend(key for key in getattr(base, '_indexed', ()) if key not in indexed)
+        meta_indexes = getattr(attrs.get('Meta'), 'indexes', ())
+        for key in meta_indexes:
+            if key not in fields:
+                raise ValueError(f"Cannot index {key}, it is not a field of {name}")
+        for key, field in fields.items():
+            if key not in indexed and (field.primary_key or field.unique or field.index or key == attrs['_pk'] or key in meta_indexes):
+                indexed.append(key)
+        attrs['_indexed'] = tuple(indexed)
+        # ordered indexes (range_index=True or Meta.range_indexes), see SortedIndex
+        range_indexed = []
+        for base in bases:
+            range_indexed.extend(key for key in getattr(base, '_range_indexed', ()) if key not in range_indexed)
+        meta_range_indexes = getattr(attrs.get('Meta'), 'range_indexes', ())
+        for key, field in fields.items():
+            if key in range_indexed or not (field.range_index or key in meta_range_indexes):
+                continue
+            if not isinstance(field, (IntegerField, FloatField, DateField, DateTimeField)):
+                raise ValueError(f"Cannot range index {key}, only Integer, Float, Date and DateTime fields can be")
+            range_indexed.append(key)
+        for key in meta_range_indexes:
+            if key not in fields:
+                raise ValueError(f"Cannot range index {key}, it is not a field of {name}")
+        attrs['_range_indexed'] = tuple(range_indexed)
+        validators = {key: _compile_validator(field) for key, field in fields.items()}
+        attrs['_validators'] = validators
+        attrs['_row_validators'] = tuple((key, validators[key], field.default) for key, field in fields.items())
         return super().__new__(cls, name, bases, attrs)
 
+def _compile_validator(field: Field):
+    check = field._compile()
+    # relations can be given the record itself, only its id is kept
+    if isinstance(field, ForeignKeyField):
+        def check_foreign_key(value):
+            return check(value.id if isinstance(value, Table) else value)
+        return check_foreign_key
+    if isinstance(field, ManyToManyField):
+        def check_many_to_many(value):
+            if value is not None:
+                value = [v.id if isinstance(v, Table) else v for v in value]
+            return check(value)
+        return check_many_to_many
+    return check
+
 class Table(metaclass=TableMeta):
+    # both set by Database.add_record: _db so index upkeep can happen on assignment,
+    # _row is the record's position in its table, which is what the indexes store
+    __slots__ = ('_db', '_row')
+
     def __init__(self, **kwargs):
-        for key, field in self._fields.items():
-            value = kwargs.get(key, field.default)
-            if isinstance(field, ForeignKeyField):
-                value = value.id if isinstance(value, Table) else value
-            elif isinstance(field, ManyToManyField):
-                value = [v.id if isinstance(v, Table) else v for v in value]
-            setattr(self, key, field.validate(value))
+        set_value = object.__setattr__
+        set_value(self, '_db', None)
+        set_value(self, '_row', None)
+        for key, value in self._validate_row(kwargs).items():
+            set_value(self, key, value)
+
+    @classmethod
+    def _validate_row(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        # one pass over the compiled validators, missing fields get their default
+        return {key: check(values.get(key, default)) for key, check, default in cls._row_validators}
 
     def __setattr__(self, key, value):
-        if key in self._fields:
-            field = self._fields[key]
-            if isinstance(field, ForeignKeyField):
-                value = value.id if isinstance(value, Table) else value
-            elif isinstance(field, ManyToManyField):
-                value = [v.id if isinstance(v, Table) else v for v in value]
-            value = field.validate(value)
+        check = self._validators.get(key)
+        if check is not None:
+            value = check(value)
+            db = self._db
+            if db is not None:
+                with db._write_lock():
+                    db._update_indexes(self, key, value)
+                    super().__setattr__(key, value)
+                return
         super().__setattr__(key, value)
     def to_dict(self) -> Dict[str, Any]:
         return {key: getattr(self, key) for key in self._fields}
@@ -285,6 +511,23 @@ class Table(metaclass=TableMeta):
     def from_dict(cls, data: Dict[str, Any]) -> 'Table':
         return cls(**data)
 
+    @classmethod
+    def _from_trusted(cls, values: Dict[str, Any], verify: bool = False) -> 'Table':
+        ## for values that are already the right types (our own files, bulk imports),
+        ## assigns them straight into the slots without any validation or coercion.
+        ## relations have to already be raw ids here, verify=True runs the table's row validator
+        record = object.__new__(cls)
+        set_value = object.__setattr__
+        set_value(record, '_db', None)
+        set_value(record, '_row', None)
+        if verify:
+            for key, value in cls._validate_row(values).items():
+                set_value(record, key, value)
+            return record
+        for key, field in cls._fields.items():
+            set_value(record, key, values.get(key, field.default))
+        return record
+
     @classmethod
     def from_json(cls, json_str: str) -> 'Table':
         return cls.from_dict(json.loads(json_str))
@@ -318,12 +561,666 @@ class Table(metaclass=TableMeta):
     # table with splitters and padding and organization
     # would be cool
 
-class Database:
+class SortedIndex:
+    ## ordered index over one field: the keys are kept sorted in a list with the row numbers
+    ## of their records in a parallel list, so a range is two bisects and a slice and walking
+    ## the table in order needs no sorting. rows whose value is None sit in `nulls` and always come last
     def __init__(self):
+        self.keys: List[Any] = []
+        self.rows: List[int] = []
+        self.nulls: Dict[int, None] = {} # a dict so they stay in insertion order
+
+    def __len__(self) -> int:
+        return len(self.rows) + len(self.nulls)
+
+    def add(self, value, row: int):
+        if value is None:
+            self.nulls[row] = None
+            return
+        keys = self.keys
+        if not keys or value >= keys[-1]: # ids and timestamps mostly arrive in order
+            keys.append(value)
+            self.rows.append(row)
+            return
+        position = bisect_right(keys, value)
+        keys.insert(position, value)
+        self.rows.insert(position, row)
+
+    def extend(self, pairs):
+        # bulk version of add: one stable sort instead of a list insert per record
+        pairs = list(pairs)
+        for value, row in pairs:
+            if value is None:
+                self.nulls[row] = None
+        merged = list(zip(self.keys, self.rows))
+        merged.extend(pair for pair in pairs if pair[0] is not None)
+        merged.sort(key=lambda pair: pair[0])
+        self.keys = [pair[0] for pair in merged]
+        self.rows = [pair[1] for pair in merged]
+
+    def remove(self, value, row: int):
+        if value is None:
+            self.nulls.pop(row, None)
+            return
+        keys = self.keys
+        rows = self.rows
+        for position in range(bisect_left(keys, value), bisect_right(keys, value)):
+            if rows[position] == row:
+                del keys[position]
+                del rows[position]
+                return
+
+    def remove_all(self, doomed):
+        # bulk version of remove, one pass instead of a bisect + list delete each
+        kept = [(value, row) for value, row in zip(self.keys, self.rows) if row not in doomed]
+        self.keys = [pair[0] for pair in kept]
+        self.rows = [pair[1] for pair in kept]
+        for row in doomed:
+            self.nulls.pop(row, None)
+
+    def remap(self, moved: List[int]):
+        # after the table is compacted, moved[old row] is the new row (order is kept so keys stay sorted)
+        self.rows = [moved[row] for row in self.rows]
+        self.nulls = {moved[row]: None for row in self.nulls}
+
+    def range(self, low=None, high=None, include_low: bool = True, include_high: bool = True, descending: bool = False) -> List[int]:
+        keys = self.keys
+        if low is None:
+            start = 0
+        else:
+            start = bisect_left(keys, low) if include_low else bisect_right(keys, low)
+        if high is None:
+            end = len(keys)
+        else:
+            end = bisect_right(keys, high) if include_high else bisect_left(keys, high)
+        rows = self.rows[start:end]
+        if descending:
+            rows.reverse()
+        return rows
+
+    def ordered(self, descending: bool = False) -> List[int]:
+        return self.range(descending=descending) + list(self.nulls)
+
+class _ColumnAttribute:
+    # stands in for a field on column store rows, reads/writes go to the column
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return obj._store.columns[self.name][obj._row]
+
+    def __set__(self, obj, value):
+        obj._store._set(self.name, obj._row, value)
+
+class _DetachedRow:
+    db = None
+
+    def __init__(self, values: Dict[str, Any]):
+        self.columns = {name: [value] for name, value in values.items()}
+
+    def _set(self, name: str, row: int, value):
+        self.columns[name][row] = value
+
+class ColumnStore:
+    ## columnar storage for one table (Database(storage="columnar")):
+    ## every field is one column, ints and floats go in typed arrays and everything else
+    ## in a plain list. records are tiny views (a subclass of the table) pointing at a row
+    ## number, so they still validate + keep indexes updated through Table.__setattr__.
+    ## views are only made when something asks for a record and sit in a weak cache, so the
+    ## same row gives back the same view while anyone holds on to it and costs nothing after
+    def __init__(self, table: Type[Table], db: 'Database'):
+        self.table = table
+        self.columns: Dict[str, Union[array, list]] = {name: self._new_column(field) for name, field in table._fields.items()}
+        attrs = {name: _ColumnAttribute(name) for name in table._fields}
+        attrs['__slots__'] = ('_store', '__weakref__')
+        attrs['_db'] = property(lambda view: view._store.db)
+        self.db = db
+        self.view_class = type(table.__name__, (table,), attrs)
+        self.length = 0
+        self._views: Dict[int, weakref.KeyedRef] = {} # row -> weak reference to its view
+        # bumped on every change, so anything derived from the columns (like the numpy
+        # arrays scql builds for where: blocks) knows when it's stale
+        self.version = 0
+        self._arrays: Dict[str, tuple] = {}
+
+    @staticmethod
+    def _new_column(field: Field):
+        if field.field_type is int:
+            return array('q')
+        if field.field_type is float:
+            return array('d')
+        return []
+
+    def _store_value(self, name: str, value, row: Optional[int] = None):
+        column = self.columns[name]
+        try:
+            if row is None:
+                column.append(value)
+            else:
+                column[row] = value
+        except (TypeError, OverflowError):
+            # None or an int too big for the array, this column has to be a list from now on
+            column = self.columns[name] = list(column)
+            if row is None:
+                column.append(value)
+            else:
+                column[row] = value
+
+    def _set(self, name: str, row: int, value):
+        self._store_value(name, value, row)
+        self.version += 1
+
+    def view(self, row: int) -> Table:
+        ref = self._views.get(row)
+        view = ref() if ref is not None else None
+        if view is None:
+            view = object.__new__(self.view_class)
+            object.__setattr__(view, '_store', self)
+            object.__setattr__(view, '_row', row)
+            self._views[row] = weakref.KeyedRef(view, self._forget, row)
+        return view
+
+    def _forget(self, ref: weakref.KeyedRef):
+        # a view got garbage collected. dicts never shrink by themselves, so once every view is
+        # gone (eg. a big add_records result got dropped) start over with an empty one
+        views = self._views
+        if views.get(ref.key) is ref:
+            del views[ref.key]
+            if not views:
+                self._views = {}
+
+    def append(self, record: Table) -> int:
+        row = self.length
+        self.version += 1
+        for name in self.columns:
+            self._store_value(name, getattr(record, name))
+        self.length += 1
+        return row
+
+    def column(self, name: str) -> Union[array, list]:
+        return self.columns[name]
+
+    def detach(self, rows):
+        # a deleted row's view (if anyone still has one) keeps its last values but stops talking to the database
+        for row in rows:
+            ref = self._views.pop(row, None)
+            view = ref() if ref is not None else None
+            if view is not None:
+                object.__setattr__(view, '_store', _DetachedRow({name: column[row] for name, column in self.columns.items()}))
+                object.__setattr__(view, '_row', 0)
+
+    def compact(self, dead) -> List[int]:
+        ## drops the dead rows from every column in one pass, returns a list of old row -> new row
+        ## (-1 for the dropped ones) so the database can renumber its indexes
+        self.version += 1
+        moved = []
+        keep = []
+        for row in range(self.length):
+            if row in dead:
+                moved.append(-1)
+            else:
+                moved.append(len(keep))
+                keep.append(row)
+        for name, column in self.columns.items():
+            kept = [column[row] for row in keep]
+            self.columns[name] = array(column.typecode, kept) if isinstance(column, array) else kept
+        views = [(row, ref()) for row, ref in list(self._views.items())]
+        self._views = {}
+        for row, view in views:
+            if view is not None:
+                object.__setattr__(view, '_row', moved[row])
+                self._views[moved[row]] = weakref.KeyedRef(view, self._forget, moved[row])
+        self.length = len(keep)
+        return moved
+
+    def values(self):
+        # raw value tuples in field order, no views involved
+        return zip(*self.columns.values())
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        return map(self.view, range(self.length))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.view(row) for row in range(self.length)[index]]
+        return self.view(range(self.length)[index])
+
+    def __repr__(self):
+        return repr(list(self))
+
+def _value_encoder(extend):
+    ## (write_string, write_value) that append the binary format's encoding to whatever
+    ## extend belongs to, shared by the .scdb writer and the write ahead log
+    pack_u32 = _U32.pack
+    pack_i64 = _I64.pack
+    pack_f64 = _F64.pack
+
+    def write_string(s):
+        encoded = s.encode('utf-8')
+        extend(pack_u32(len(encoded)))
+        extend(encoded)
+
+    def write_value(value):
+        if isinstance(value, str):
+            extend(b'\x01')
+            write_string(value)
+        elif isinstance(value, bool):
+            extend(b'\x04')
+            extend(b'\x01' if value else b'\x00')
+        elif isinstance(value, int):
+            extend(b'\x02')
+            extend(pack_i64(value))
+        elif isinstance(value, float):
+            extend(b'\x03')
+            extend(pack_f64(value))
+        elif value is None:
+            extend(b'\x05')
+        elif isinstance(value, Table):
+            extend(b'\x06')
+            write_string(value.__class__.__name__)
+            extend(pack_i64(value.id))
+        elif isinstance(value, datetime):
+            extend(b'\x09')
+            extend(_DATETIME.pack(value.year, value.month, value.day, value.hour, value.minute, value.second))
+        elif isinstance(value, date):
+            extend(b'\x07')
+            extend(_DATE.pack(value.year, value.month, value.day))
+        elif isinstance(value, time):
+            extend(b'\x08')
+            extend(_TIME.pack(value.hour, value.minute, value.second))
+        elif isinstance(value, list):
+            extend(b'\x0A')
+            extend(pack_u32(len(value)))
+            for item in value:
+                write_value(item)
+        elif isinstance(value, TableEnum):
+            extend(b'\x0B')
+            write_string(value.name)
+        else:
+            raise ValueError(f"Unsupported type: {type(value)}")
+
+    return write_string, write_value
+
+class Cursor:
+    ## lazy query results (Database.find, SCQL get). nothing is looked at until the cursor
+    ## is iterated, and first()/limit()/chunks() only pull as many records as they need.
+    ## every iteration runs the lookup again, so if you're going to change the table
+    ## while going through the results, to_list() them first
+    def __init__(self, source: Callable[[], Iterable], limit: Optional[int] = None, description: str = ""):
+        self._source = source
+        self._limit = limit
+        self.description = description
+
+    def __iter__(self) -> Iterator:
+        records = iter(self._source())
+        if self._limit is not None:
+            return islice(records, self._limit)
+        return records
+
+    def first(self):
+        # the first match or None, stops looking after it
+        return next(iter(self), None)
+
+    def limit(self, count: int) -> 'Cursor':
+        if count < 0:
+            raise ValueError("Cursor limit can't be negative")
+        if self._limit is not None:
+            count = min(count, self._limit)
+        return Cursor(self._source, count, self.description)
+
+    def count(self) -> int:
+        records = self._source()
+        if hasattr(records, '__len__'): # the whole table, no need to walk it
+            return len(records) if self._limit is None else min(len(records), self._limit)
+        if self._limit is not None:
+            records = islice(records, self._limit)
+        count = 0
+        for _ in records:
+            count += 1
+        return count
+
+    def chunks(self, size: int) -> Iterator[list]:
+        # lists of up to size records at a time
+        if size < 1:
+            raise ValueError("Chunk size must be at least 1")
+        records = iter(self)
+        while True:
+            chunk = list(islice(records, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def to_list(self) -> list:
+        return list(self)
+
+    def __repr__(self):
+        limit = f" limit {self._limit}" if self._limit is not None else ""
+        return f"Cursor({self.description}{limit})"
+
+class _BinaryReader:
+    ## reads the binary format through a memoryview with unpack_from so nothing
+    ## gets copied per field, works the same over bytes or a mmap'd file
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.pos = 0
+        self.version = 1 # bumped by the header check for newer files
+
+    def release(self):
+        self.view.release()
+
+    def header(self):
+        # v1 files have no header, they start straight with the enum count
+        if self.view[:4] == _MAGIC:
+            self.version = self.view[4]
+            self.pos = 5
+            if self.version > _FORMAT_VERSION:
+                raise ValueError(f"Unsupported database format version: {self.version}")
+
+    def footer(self) -> tuple:
+        # v3 only, returns ({table: (offset, length, record count)}, schema offset)
+        view = self.view
+        if len(view) < 17 or view[-4:] != _MAGIC:
+            raise ValueError("Database file is missing its footer, it was probably cut off")
+        self.pos = _U64.unpack_from(view, len(view) - 12)[0]
+        directory = {}
+        for _ in range(self.u32()):
+            table_name = self.string()
+            offset, length = _U64.unpack_from(view, self.pos)[0], _U64.unpack_from(view, self.pos + 8)[0]
+            self.pos += 16
+            directory[table_name] = (offset, length, self.u32())
+        return directory, _U64.unpack_from(view, self.pos)[0]
+
+    def u32(self) -> int:
+        value = _U32.unpack_from(self.view, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def string(self) -> str:
+        length = _U32.unpack_from(self.view, self.pos)[0]
+        start = self.pos + 4
+        self.pos = start + length
+        return str(self.view[start:self.pos], 'utf-8')
+
+    def value(self):
+        view = self.view
+        value_type = view[self.pos]
+        self.pos += 1
+        if value_type == 0x01:
+            return self.string()
+        elif value_type == 0x02:
+            value = _I64.unpack_from(view, self.pos)[0]
+            self.pos += 8
+            return value
+        elif value_type == 0x03:
+            value = _F64.unpack_from(view, self.pos)[0]
+            self.pos += 8
+            return value
+        elif value_type == 0x04:
+            value = view[self.pos] != 0
+            self.pos += 1
+            return value
+        elif value_type == 0x05:
+            return None
+        elif value_type == 0x06:
+            table_name = self.string()
+            obj_id = _I64.unpack_from(view, self.pos)[0]
+            self.pos += 8
+            return (table_name, obj_id)
+        elif value_type == 0x07:
+            year, month, day = _DATE.unpack_from(view, self.pos)
+            self.pos += 12
+            return date(year, month, day)
+        elif value_type == 0x08:
+            hour, minute, second = _TIME.unpack_from(view, self.pos)
+            self.pos += 12
+            return time(hour, minute, second)
+        elif value_type == 0x09:
+            year, month, day, hour, minute, second = _DATETIME.unpack_from(view, self.pos)
+            self.pos += 24
+            return datetime(year, month, day, hour, minute, second)
+        elif value_type == 0x0A:
+            array_length = self.u32()
+            return [self.value() for _ in range(array_length)]
+        elif value_type == 0x0B:
+            enum_name = self.string()
+            enum_values = json.loads(self.string())
+            return TableEnum(enum_name, enum_values)
+        else:
+            raise ValueError(f"Unsupported value type: {value_type}")
+
+    def skip_string(self):
+        self.pos += 4 + _U32.unpack_from(self.view, self.pos)[0]
+
+    def skip_value(self):
+        # same walk as value() without building anything
+        value_type = self.view[self.pos]
+        self.pos += 1
+        if value_type == 0x01:
+            self.skip_string()
+        elif value_type == 0x02 or value_type == 0x03:
+            self.pos += 8
+        elif value_type == 0x04:
+            self.pos += 1
+        elif value_type == 0x05:
+            pass
+        elif value_type == 0x06:
+            self.skip_string()
+            self.pos += 8
+        elif value_type == 0x07 or value_type == 0x08:
+            self.pos += 12
+        elif value_type == 0x09:
+            self.pos += 24
+        elif value_type == 0x0A:
+            for _ in range(self.u32()):
+                self.skip_value()
+        elif value_type == 0x0B:
+            self.skip_string()
+            self.skip_string()
+        else:
+            raise ValueError(f"Unsupported value type: {value_type}")
+
+    def skip_rows(self, num_records: int):
+        if self.version >= 2:
+            self.pos += 8 + _U64.unpack_from(self.view, self.pos)[0]
+            return
+        for _ in range(num_records):
+            for _ in range(self.u32()):
+                self.skip_string()
+                self.skip_value()
+
+_NO_LOCK = nullcontext() # stands in for the log lock when there isn't a log, reusable
+
+class _WriteAheadLog:
+    ## append only log next to a .scdb file (filename + ".wal") of every insert, update and
+    ## delete since the last snapshot, so a change costs one small append instead of a save.
+    ## entries are a u32 payload length + u32 crc32 of the payload + the payload:
+    ##   op byte, table name, primary key, then
+    ##   insert: u32 value count + the record's values in field order
+    ##   update: field name + new value
+    ##   delete: nothing
+    ## values use the .scdb value encoding. replaying is keyed by primary key and idempotent
+    ## (inserts replace, updates/deletes of missing records are skipped) so replaying entries
+    ## a snapshot already has is harmless
+    INSERT = 1
+    UPDATE = 2
+    DELETE = 3
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.RLock()
+        self.pending = bytearray() # framed entries not written yet (inside a batch)
+        self.payload = bytearray()
+        self.write_string, self.write_value = _value_encoder(self.payload.extend)
+        self.depth = 0
+        # a crash can leave half an entry at the end, cut it off so new ones stay reachable
+        end = self.valid_length(path) if os.path.exists(path) else 0
+        self.file = open(path, 'ab')
+        if self.file.tell() != end:
+            self.file.truncate(end)
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, op: int, table_name: str, pk, values=()):
+        with self.lock:
+            payload = self.payload
+            payload.clear()
+            payload.append(op)
+            self.write_string(table_name)
+            self.write_value(pk)
+            if op == self.INSERT:
+                payload.extend(_U32.pack(len(values)))
+                for value in values:
+                    self.write_value(value)
+            elif op == self.UPDATE:
+                field_name, value = values
+                self.write_string(field_name)
+                self.write_value(value)
+            self.pending.extend(_U32.pack(len(payload)))
+            self.pending.extend(_U32.pack(zlib.crc32(payload)))
+            self.pending.extend(payload)
+            if not self.depth:
+                self.flush()
+
+    @contextmanager
+    def batch(self):
+        # entries made inside go out in one write (and one fsync) at the end
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if not self.depth:
+                    self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.file.write(self.pending)
+            self.pending.clear()
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def size(self) -> int:
+        return self.file.tell() + len(self.pending)
+
+    def truncate(self):
+        with self.lock:
+            self.pending.clear()
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.file.close()
+
+    @staticmethod
+    def entries(data) -> Iterator[tuple]:
+        ## (op, table name, pk, values) for every intact entry, stops at the first torn/corrupt one
+        reader = _BinaryReader(data)
+        view = reader.view
+        try:
+            while reader.pos + 8 <= len(view):
+                length, checksum = struct.unpack_from('!II', view, reader.pos)
+                start = reader.pos + 8
+                if start + length > len(view) or zlib.crc32(view[start:start + length]) != checksum:
+                    return
+                reader.pos = start
+                op = view[start]
+                reader.pos += 1
+                table_name = reader.string()
+                pk = reader.value()
+                if op == _WriteAheadLog.INSERT:
+                    values = [reader.value() for _ in range(reader.u32())]
+                elif op == _WriteAheadLog.UPDATE:
+                    values = (reader.string(), reader.value())
+                else:
+                    values = ()
+                reader.pos = start + length
+                yield op, table_name, pk, values
+        finally:
+            reader.release()
+
+    @staticmethod
+    def valid_length(path: str) -> int:
+        # bytes up to the end of the last intact entry
+        with open(path, 'rb') as file:
+            data = file.read()
+        end = 0
+        view = memoryview(data)
+        while end + 8 <= len(view):
+            length, checksum = struct.unpack_from('!II', view, end)
+            if end + 8 + length > len(view) or zlib.crc32(view[end + 8:end + 8 + length]) != checksum:
+                break
+            end += 8 + length
+        view.release()
+        return end
+
+class Database:
+    def __init__(self, storage: str = "rows"):
+        ## storage: "rows" keeps a list of Table objects per table,
+        ## "columnar" keeps a ColumnStore per table instead
+        if storage not in ("rows", "columnar"):
+            raise ValueError(f"Unsupported storage: {storage}")
+        self.storage = storage
         self.tables: Dict[str, Type[Table]] = {}
         self.data: Dict[str, List[Table]] = {}
         self.relations: Dict[str, Dict[str, List[int]]] = {}
         self.enums: Dict[str, TableEnum] = {}
+        # table -> field -> value -> row number of the record (or a set of them when shared)
+        # which fields get one is decided by TableMeta (Table._indexed)
+        self.indexes: Dict[str, Dict[str, Dict[Any, Any]]] = {}
+        # table -> field -> SortedIndex, for range_index fields
+        self.range_indexes: Dict[str, Dict[str, SortedIndex]] = {}
+        # "who points at me": table -> relation field -> target pk -> row(s), same shape as
+        # the hash indexes. for foreign keys it's the field's hash index itself (they always get
+        # one), many to many + relation fields get their own, kept up in _add_record and co.
+        self.reverse_indexes: Dict[str, Dict[str, Dict[Any, Any]]] = {}
+        self._reverse_fields: Dict[str, Dict[str, Field]] = {}
+        # lazy loads: table -> (reader, offset, record count) of records not decoded yet
+        self._pending: Dict[str, tuple] = {}
+        self._verify_loads = False
+        self._pending_reader: Optional[_BinaryReader] = None
+        self._pending_source = None
+        self._pending_file: Optional[str] = None # what _pending_source maps
+        self._loading = set()
+        # SCQL text -> Plan, least recently used first. plans depend on the tables,
+        # indexes and enums so _schema_version bumps whenever those change
+        self._plans: OrderedDict = OrderedDict()
+        self._schema_version = 0
+        # write ahead log (enable_wal), None when changes only hit the disk on save
+        self._wal: Optional[_WriteAheadLog] = None
+        self._wal_file: Optional[str] = None
+        self._checkpoint_bytes: Optional[int] = None
+        self._checkpoint_thread: Optional[threading.Thread] = None
+        self._checkpoint_wake = threading.Event()
+        self.checkpoint_error: Optional[BaseException] = None
+        # what changed since the last load/save: table -> rows added or modified since then,
+        # a table can be in here with no rows (deletes, new tables)
+        self._dirty: Dict[str, set] = {}
+        # deleted rows still taking up their slot (None in a row list, stale values in the columns),
+        # closed up in one go by _compact the next time the whole table is needed
+        self._dead: Dict[str, set] = {}
+        # the file the data was loaded from / last saved to as (path, _file_signature), and
+        # where each table's block is in it: table -> (offset, length, record count).
+        # saving copies the blocks of clean tables straight out of there (see _save_binary)
+        self._source: Optional[tuple] = None
+        self._blocks: Dict[str, tuple] = {}
+        # partial loads (load_from_file(tables=..., fields=...)): table -> every field the
+        # file has in order, for tables that only got some of them, and the file itself
+        # so it doesnt get saved over with the missing bits
+        self._file_fields: Dict[str, List[str]] = {}
+        self._partial_file: Optional[str] = None
 
     
     def run_admin_panel(self, port=5000, debug=True, save_path="database.scdb"):
@@ -359,6 +1256,13 @@ class Database:
         
         app.jinja_env.filters["is_many_to_many_field"] = is_many_to_many_field
 
+        @app.template_filter('related_table')
+        def related_table(field):
+            # relation fields can point at the class itself or just its name
+            return field.to if isinstance(field.to, str) else field.to.__name__
+
+        app.jinja_env.filters["related_table"] = related_table
+
         @app.route('/')
         def index():
             return render_template('index.html', tables=self.tables, enums=self.enums)
@@ -368,7 +1272,7 @@ class Database:
             table = self.tables.get(table_name)
             if table is None:
                 return "Table not found", 404
-            records = self.data.get(table_name, [])
+            records = self.all(table_name)
             return render_template('table.html', table=table, records=records)
     
         @app.route('/table/<table_name>/<int:record_id>')
@@ -376,7 +1280,7 @@ class Database:
             table = self.tables.get(table_name)
             if table is None:
                 return "Table not found", 404
-            record = next((r for r in self.data.get(table_name, []) if r.id == record_id), None)
+            record = self._get_one(table_name, id=record_id)
             if record is None:
                 return "Record not found", 404
             return render_template('record.html', table=table, record=record)
@@ -386,7 +1290,7 @@ class Database:
             table = self.tables.get(table_name)
             if table is None:
                 return "Table not found", 404
-            record = next((r for r in self.data.get(table_name, []) if r.id == record_id), None)
+            record = self._get_one(table_name, id=record_id)
             if record is None:
                 return "Record not found", 404
 
@@ -395,13 +1299,9 @@ class Database:
                     if key in request.form:
                         value = request.form[key]
                         if isinstance(field, ForeignKeyField):
-                            related_table = self.get_table(field.to)
-                            related_record = self.get(related_table.__name__, id=int(value))
-                            value = related_record
+                            value = self._relation_resolver(field)(int(value))
                         elif isinstance(field, ManyToManyField):
-                            related_table = self.get_table(field.to)
-                            related_records = [self.get(related_table.__name__, id=int(v)) for v in value.split(',')]
-                            value = related_records
+                            value = self._relation_resolver(field)([int(v) for v in value.split(',')])
                         elif isinstance(field, EnumField):
                             enum_val = request.form.get(key)
                             value = field.enum.values[enum_val]
@@ -425,7 +1325,11 @@ class Database:
         
         @app.route('/save', methods=['POST'])
         def save():
-            self.save_to_file(save_path, "bin")
+            if self._wal is not None and self._wal_file == save_path:
+                # edits are already in the log, just fold it into the file
+                self.checkpoint()
+            else:
+                self.save_to_file(save_path, "bin")
             return redirect(url_for('index'))
         
         @app.route('/reload', methods=['POST'])
@@ -448,286 +1352,1318 @@ class Database:
         return self.enums.get(enum_name)
     
     def get_related_table_record(self, table_name: str, record_id: int, related_table_name: str) -> List[Table]:
+        if self._pending:
+            self._ensure_loaded(table_name)
         relation_table_name = f"{table_name}_{related_table_name}"
         related_ids = self.relations.get(relation_table_name, {}).get(record_id, [])
-        return [self.get(related_table_name, id=rid) for rid in related_ids]
+        lookup = self._pk_lookup(related_table_name)
+        return [lookup(rid) for rid in related_ids]
+
+    def _pk_lookup(self, table_name: str) -> Callable[[Any], Optional[Table]]:
+        ## primary key -> record for one table, straight off the pk hash index
+        table = self.get_table(table_name)
+        if table is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        if table._pk is None:
+            raise ValueError(f"Table {table_name} has no primary key to look records up by")
+        self.all(table_name)
+        index = self.indexes[table_name].get(table._pk)
+        if index is None: # pk is an array field, nothing we can hash on
+            return lambda value: None
+        get = self._record_getter(table_name)
+
+        def lookup(value):
+            if value is None:
+                return None
+            try:
+                bucket = index.get(value)
+            except TypeError:
+                return None
+            if bucket is None:
+                return None
+            if type(bucket) is set: # pk that isnt unique, first one wins like get would
+                return get(min(bucket))
+            return get(bucket)
+        return lookup
+
+    def _relation_resolver(self, field: Field) -> Callable[[Any], Any]:
+        # stored relation value -> the related record (ForeignKeyField, RelationField) or records (ManyToManyField)
+        if isinstance(field, RelationField):
+            return lambda value: value
+        lookup = self._pk_lookup(field.to if isinstance(field.to, str) else field.to.__name__)
+        if isinstance(field, ForeignKeyField):
+            return lookup
+
+        def resolve_many(values):
+            if values is None:
+                return []
+            related = [lookup(value) for value in values]
+            return [record for record in related if record is not None]
+        return resolve_many
+
+    def join(self, table_name: str, field_name: str, records: Optional[Iterable[Table]] = None) -> List[tuple]:
+        ## (record, related) for every record of the table (or just the given ones), where related
+        ## is what a ForeignKeyField/RelationField points at or the list of records in a
+        ## ManyToManyField. one hash lookup per id instead of a get each
+        table = self.get_table(table_name)
+        if table is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        field = table._fields.get(field_name)
+        if not isinstance(field, (ForeignKeyField, ManyToManyField, RelationField)):
+            raise ValueError(f"{field_name} is not a relation field of {table_name}")
+        if records is None:
+            records = self.all(table_name)
+        resolve = self._relation_resolver(field)
+        return [(record, resolve(getattr(record, field_name))) for record in records]
     
     def get(self, table_name, **kwargs) -> List[Table] | Table | None:
         table = self.get_table(table_name)
         if table is None:
             raise ValueError(f"Table {table_name} does not exist in the database")
-        records = [record for record in self.data[table_name] if all(getattr(record, field_name) == value for field_name, value in kwargs.items())]
+        records = self._filter(table_name, kwargs)
         if len(records) == 1:
             return records[0]
         elif len(records) == 0:
             return None
         return records
     
+    def _candidates(self, table_name: str, equals: Dict[str, Any]):
+        ## the fewest records that could have field == value for everything in equals,
+        ## using the hash indexes (or the whole table if none apply). still needs filtering
+        if self._pending:
+            self._ensure_loaded(table_name)
+        indexes = self.indexes[table_name]
+        # out of the indexed kwargs, start from whichever has the fewest matching records
+        best = None
+        for field_name, value in equals.items():
+            index = indexes.get(field_name)
+            if index is None:
+                continue
+            try:
+                bucket = index.get(value)
+            except TypeError: # unhashable, just scan
+                continue
+            if bucket is None:
+                return ()
+            size = len(bucket) if type(bucket) is set else 1
+            if best is None or size < best[0]:
+                best = (size, bucket)
+                if size == 1:
+                    break
+        if best is not None:
+            return self._index_records(table_name, best[1])
+        return self.all(table_name)
+
+    def _filter(self, table_name: str, kwargs: Dict[str, Any]) -> List[Table]:
+        return [record for record in self._candidates(table_name, kwargs) if all(getattr(record, field_name) == value for field_name, value in kwargs.items())]
+
+    def _iter_filter(self, table_name: str, kwargs: Dict[str, Any]) -> Iterator[Table]:
+        conditions = tuple(kwargs.items())
+        for record in self._candidates(table_name, kwargs):
+            if all(getattr(record, field_name) == value for field_name, value in conditions):
+                yield record
+
+    def _get_one(self, table_name: str, **kwargs) -> Optional[Table]:
+        return next(self._iter_filter(table_name, kwargs), None)
+
+    def find(self, table_name: str, **kwargs) -> Cursor:
+        ## get without building the results up front: a Cursor over every record where
+        ## field == value for each keyword (or the whole table without any)
+        if self.get_table(table_name) is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        description = table_name + "".join(f" {key}={value!r}" for key, value in kwargs.items())
+        if not kwargs:
+            return Cursor(lambda: self.all(table_name), description=description)
+        return Cursor(lambda: self._iter_filter(table_name, kwargs), description=description)
+
+    def column(self, table_name: str, field_name: str) -> Union[array, list]:
+        # every value of one field in row order, for columnar tables this is the column itself
+        table = self.get_table(table_name)
+        if table is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        if field_name not in table._fields:
+            raise ValueError(f"Field {field_name} does not exist in table {table_name}")
+        records = self.all(table_name)
+        if isinstance(records, ColumnStore):
+            return records.column(field_name)
+        return [getattr(record, field_name) for record in records]
+
+    def range(self, table_name: str, field_name: str, low=None, high=None, include_low: bool = True, include_high: bool = True, descending: bool = False) -> List[Table]:
+        ## records with low <= field <= high (either end can be left open) in field order,
+        ## straight off the range index when the field has one. None values never match
+        records = self.all(table_name)
+        if field_name not in self.tables[table_name]._fields:
+            raise ValueError(f"Field {field_name} does not exist in table {table_name}")
+        index = self.range_indexes[table_name].get(field_name)
+        if index is not None:
+            return list(map(self._record_getter(table_name), index.range(low, high, include_low, include_high, descending)))
+        matches = []
+        for record in records:
+            value = getattr(record, field_name)
+            if value is None:
+                continue
+            if low is not None and (value < low if include_low else value <= low):
+                continue
+            if high is not None and (value > high if include_high else value >= high):
+                continue
+            matches.append(record)
+        matches.sort(key=lambda record: getattr(record, field_name), reverse=descending)
+        return matches
+
+    def order_by(self, table_name: str, field_name: str, descending: bool = False) -> List[Table]:
+        # every record ordered by one field, None values last
+        records = self.all(table_name)
+        if field_name not in self.tables[table_name]._fields:
+            raise ValueError(f"Field {field_name} does not exist in table {table_name}")
+        index = self.range_indexes[table_name].get(field_name)
+        if index is not None:
+            return list(map(self._record_getter(table_name), index.ordered(descending)))
+        present = [record for record in records if getattr(record, field_name) is not None]
+        present.sort(key=lambda record: getattr(record, field_name), reverse=descending)
+        return present + [record for record in records if getattr(record, field_name) is None]
+
     def all(self, table_name) -> List[Table]:
         table = self.get_table(table_name)
         if table is None:
             raise ValueError(f"Table {table_name} does not exist in the database")
+        if self._pending:
+            self._ensure_loaded(table_name)
+        if self._dead[table_name]:
+            self._compact(table_name)
+        # this is the table's own list (or ColumnStore), so hold on to it across deletes and
+        # it can have None where deleted records were. call all again for a clean one
         return self.data[table_name]
 
     def add_table(self, table: Type[Table]):
+        if self._wal is not None and table._pk is None:
+            raise ValueError(f"Table {table.__name__} has no primary key, the write ahead log needs one to replay changes")
         self.tables[table.__name__] = table
-        self.data[table.__name__] = []
+        self.data[table.__name__] = ColumnStore(table, self) if self.storage == "columnar" else []
+        self.indexes[table.__name__] = indexes = {key: {} for key in table._indexed if table._fields[key].field_type is not list}
+        self.range_indexes[table.__name__] = {key: SortedIndex() for key in table._range_indexed}
+        self.reverse_indexes[table.__name__] = reverse_indexes = {}
+        self._reverse_fields[table.__name__] = {}
+        for key, field in table._fields.items():
+            if isinstance(field, ForeignKeyField):
+                reverse_indexes[key] = indexes.setdefault(key, {})
+            elif isinstance(field, (ManyToManyField, RelationField)):
+                reverse_indexes[key] = {}
+                self._reverse_fields[table.__name__][key] = field
         for field in table._fields.values():
             if isinstance(field, ManyToManyField):
                 other_table_name = field.to if isinstance(field.to, str) else field.to.__name__
                 relation_table_name = f"{table.__name__}_{other_table_name}"
                 self.relations[relation_table_name] = {}
+        self._dirty[table.__name__] = set()
+        self._dead[table.__name__] = set()
+        self._blocks.pop(table.__name__, None)
+        self._schema_changed()
     
     def add_enum(self, enum: TableEnum):
         self.enums[enum.name] = enum
-
-    def add_record(self, table_name: str, record: Table):
-        if table_name in self.data:
-            self.data[table_name].append(record)
+        self._schema_changed()
+
+    def _schema_changed(self):
+        self._plans.clear()
+        self._schema_version += 1
+        if self._wal is not None:
+            # the log only has data, the new schema has to be in the snapshot it replays onto
+            self.checkpoint()
+
+    def add_record(self, table_name: str, record: Table) -> Table:
+        ## returns the stored record, which for columnar storage is a view over the
+        ## columns rather than the object passed in (changes to that one arent tracked)
+        return self._add_record(table_name, record, True)
+
+    def _add_record(self, table_name: str, record: Table, update_range_indexes: bool) -> Table:
+        return self._record_getter(table_name)(self._insert(table_name, record, update_range_indexes))
+
+    def _insert(self, table_name: str, record: Table, update_range_indexes: bool) -> int:
+        # stores the record and returns its row. index values are read off the record passed in,
+        # for columnar tables those are the same values that just went into the columns
+        if table_name not in self.data:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        with self._write_lock():
+            if self._pending:
+                self._ensure_loaded(table_name)
+            records = self.data[table_name]
+            if isinstance(records, ColumnStore):
+                row = records.append(record)
+            else:
+                row = len(records)
+                records.append(record)
+                object.__setattr__(record, '_row', row)
+                record._db = self
+            for key, index in self.indexes[table_name].items():
+                self._index_add(index, getattr(record, key), row)
+            reverse_indexes = self.reverse_indexes[table_name]
+            for key, field in self._reverse_fields[table_name].items():
+                index = reverse_indexes[key]
+                for target in self._reverse_keys(field, getattr(record, key)):
+                    self._index_add(index, target, row)
+            if update_range_indexes:
+                for key, index in self.range_indexes[table_name].items():
+                    index.add(getattr(record, key), row)
+            if self._wal is not None and table_name not in self._loading:
+                self._log(_WriteAheadLog.INSERT, table_name, record, [getattr(record, key) for key in record._fields])
+            if table_name not in self._loading:
+                self._dirty.setdefault(table_name, set()).add(row)
             for key, field in record._fields.items():
                 if isinstance(field, ManyToManyField):
                     other_table_name = field.to if isinstance(field.to, str) else field.to.__name__
                     relation_table_name = f"{table_name}_{other_table_name}"
                     if record.id not in self.relations[relation_table_name]:
                         self.relations[relation_table_name][record.id] = []
-                    self.relations[relation_table_name][record.id].extend(getattr(record, key))
-        else:
-            raise ValueError(f"Table {table_name} does not exist in the database")
+                    self.relations[relation_table_name][record.id].extend(getattr(record, key) or ())
+            return row
     
-    def add_records(self, table_name: str, records: List[Table]):
-        for record in records:
-            self.add_record(table_name, record)
-    
-    def serialize_to_binary(self):
-        import struct
-
-        def encode_string(s):
-            encoded = s.encode('utf-8')
-            return struct.pack('!I', len(encoded)) + encoded
-
-        def encode_value(value):
-            if isinstance(value, str):
-                return b'\x01' + encode_string(value)
-            elif isinstance(value, int):
-                return b'\x02' + struct.pack('!q', value)
-            elif isinstance(value, float):
-                return b'\x03' + struct.pack('!d', value)
-            elif isinstance(value, bool):
-                return b'\x04' + struct.pack('!?', value)
-            elif value is None:
-                return b'\x05'
-            elif isinstance(value, Table):
-                return b'\x06' + encode_string(value.__class__.__name__) + struct.pack('!q', value.id)
-            elif isinstance(value, date):
-                if isinstance(value, datetime):
-                    return b'\x09' + struct.pack('!IIIIII', value.year, value.month, value.day, value.hour, value.minute, value.second)
-                else:
-                    return b'\x07' + struct.pack('!III', value.year, value.month, value.day)
-            elif isinstance(value, time):
-                return b'\x08' + struct.pack('!III', value.hour, value.minute, value.second)
-            elif isinstance(value, list):
-                encoded_list = b'\x0A' + struct.pack('!I', len(value))
-                for item in value:
-                    encoded_list += encode_value(item)
-                return encoded_list
-            elif isinstance(value, TableEnum):
-                return b'\x0B' + encode_string(value.name)
+    def delete(self, table_name: str, *pks, on_delete: str = "restrict") -> int:
+        ## removes the records with these primary keys, see _delete_records for on_delete.
+        ## returns how many records of table_name went (pks that dont exist are skipped)
+        table = self.get_table(table_name)
+        if table is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        if table._pk is None:
+            raise ValueError(f"Table {table_name} has no primary key, use delete_where")
+        records = {}
+        for pk in pks:
+            for record in self._candidates(table_name, {table._pk: pk}):
+                if getattr(record, table._pk) == pk:
+                    records[record._row] = record
+        return self._delete_records(table_name, list(records.values()), on_delete)
+
+    def delete_where(self, table_name: str, on_delete: str = "restrict", **kwargs) -> int:
+        # delete for every record where field == value for each keyword
+        if self.get_table(table_name) is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        return self._delete_records(table_name, self._filter(table_name, kwargs), on_delete)
+
+    def _delete_records(self, table_name: str, records: List[Table], on_delete: str = "restrict") -> int:
+        ## deletes with the relations kept consistent. anything a foreign key or relation field
+        ## of another record points at is handled by on_delete:
+        ##   "restrict" - refuse (ValueError) and change nothing
+        ##   "cascade"  - delete the records pointing at it too, and so on down
+        ##   "set_null" - set those fields to None (the field has to be nullable)
+        ## many to many lists just lose the deleted ids whatever on_delete is.
+        ## the whole thing is worked out before anything is touched, so an error leaves the
+        ## database as it was. the referencing records are found through the reverse indexes
+        if on_delete not in ("restrict", "cascade", "set_null"):
+            raise ValueError(f"Unknown on_delete: {on_delete}, use restrict, cascade or set_null")
+        with self._wal_batch():
+            return self._delete_planned(table_name, records, on_delete)
+
+    def _delete_planned(self, table_name: str, records: List[Table], on_delete: str) -> int:
+        # everything below is keyed by row, records are only renumbered once _remove_records runs
+        doomed: Dict[str, Dict[int, Table]] = {table_name: {record._row: record for record in records}}
+        gone: Dict[str, set] = {} # table -> deleted pks, for the many to many cleanup
+        to_null = [] # (record, field name)
+        batches = [(table_name, list(doomed[table_name].values()))]
+        while batches:
+            target_name, batch = batches.pop()
+            pk = self.tables[target_name]._pk
+            if pk is None or not batch:
+                continue
+            keys = [getattr(record, pk) for record in batch]
+            gone.setdefault(target_name, set()).update(keys)
+            for source_name, field_name in self._referencing_fields(target_name):
+                if self._pending:
+                    self._ensure_loaded(source_name)
+                field = self.tables[source_name]._fields[field_name]
+                if isinstance(field, ManyToManyField):
+                    continue
+                index = self.reverse_indexes[source_name][field_name]
+                source_doomed = doomed.setdefault(source_name, {})
+                cascaded = []
+                for key in keys:
+                    for record in self._index_records(source_name, index.get(key)):
+                        if record._row in source_doomed:
+                            continue
+                        if on_delete == "restrict":
+                            raise ValueError(f"Can't delete {target_name} {key}, {source_name}.{field_name} still points at it (use on_delete='cascade' or 'set_null')")
+                        if on_delete == "set_null":
+                            if not field.null:
+                                raise ValueError(f"Can't set {source_name}.{field_name} to null for deleting {target_name} {key}, the field isn't nullable")
+                            to_null.append((record, field_name))
+                        else:
+                            source_doomed[record._row] = record
+                            cascaded.append(record)
+                if cascaded:
+                    batches.append((source_name, cascaded))
+        # many to many lists, found through their reverse indexes
+        cleanups = {}
+        for target_name, keys in gone.items():
+            for source_name, field_name in self._referencing_fields(target_name):
+                field = self.tables[source_name]._fields[field_name]
+                if not isinstance(field, ManyToManyField):
+                    continue
+                if self._pending:
+                    self._ensure_loaded(source_name)
+                index = self.reverse_indexes[source_name][field_name]
+                source_doomed = doomed.get(source_name, {})
+                for key in keys:
+                    for record in self._index_records(source_name, index.get(key)):
+                        if record._row not in source_doomed:
+                            cleanups.setdefault((source_name, record._row, field_name), (record, field_name, keys))
+        for record, field_name in to_null:
+            if record._row not in doomed.get(record.__class__.__name__, {}):
+                setattr(record, field_name, None)
+        for record, field_name, keys in cleanups.values():
+            setattr(record, field_name, [value for value in getattr(record, field_name) if value not in keys])
+        removed = 0
+        for doomed_table, doomed_records in doomed.items():
+            count = self._remove_records(doomed_table, list(doomed_records.values()))
+            if doomed_table == table_name:
+                removed = count
+        return removed
+
+    def _remove_records(self, table_name: str, records: List[Table]) -> int:
+        ## takes records out of the table and every index in one pass over the table,
+        ## no relation checks here (that's _delete_records)
+        doomed = {record._row: record for record in records}
+        if not doomed:
+            return 0
+        indexes = self.indexes[table_name]
+        range_indexes = self.range_indexes[table_name]
+        reverse_indexes = self.reverse_indexes[table_name]
+        reverse_fields = self._reverse_fields[table_name].items()
+        table = self.tables[table_name]
+        relation_tables = [
+            f"{table_name}_{field.to if isinstance(field.to, str) else field.to.__name__}"
+            for field in table._fields.values() if isinstance(field, ManyToManyField)
+        ]
+        # the lock covers logging through to the rows being gone, see _write_lock
+        with self._write_lock():
+            if self._wal is not None:
+                with self._wal.batch():
+                    for record in doomed.values():
+                        self._log(_WriteAheadLog.DELETE, table_name, record)
+            self._dirty.setdefault(table_name, set()).difference_update(doomed)
+            for row, record in doomed.items():
+                for key, index in indexes.items():
+                    self._index_remove(index, getattr(record, key), row)
+                for key, field in reverse_fields:
+                    for target in self._reverse_keys(field, getattr(record, key)):
+                        self._index_remove(reverse_indexes[key], target, row)
+                if len(doomed) <= 32:
+                    for key, index in range_indexes.items():
+                        index.remove(getattr(record, key), row)
+                for relation_table_name in relation_tables:
+                    self.relations[relation_table_name].pop(record.id, None)
+            if len(doomed) > 32:
+                for index in range_indexes.values():
+                    index.remove_all(doomed)
+            # the rows are only marked dead here, moving everything after them down (and renumbering
+            # the indexes) waits for the next full scan, or until half the table is gaps
+            data = self.data[table_name]
+            if isinstance(data, ColumnStore):
+                data.detach(doomed)
             else:
-                raise ValueError(f"Unsupported type: {type(value)}")
+                for row, record in doomed.items():
+                    data[row] = None
+                    record._db = None
+                    object.__setattr__(record, '_row', None)
+            dead = self._dead[table_name]
+            dead.update(doomed)
+            if len(dead) * 2 > len(data):
+                self._compact(table_name)
+            return len(doomed)
+
+    def _compact(self, table_name: str):
+        ## closes up the gaps deleted rows left behind and renumbers every index to match.
+        ## row order is kept, so sorted indexes stay sorted
+        with self._write_lock():
+            if not self._dead[table_name]: # someone else got here first
+                return
+            data = self.data[table_name]
+            dead, self._dead[table_name] = self._dead[table_name], set()
+            if isinstance(data, ColumnStore):
+                moved = data.compact(dead)
+            else:
+                moved = []
+                kept = []
+                for record in data:
+                    if record is None:
+                        moved.append(-1)
+                        continue
+                    moved.append(len(kept))
+                    object.__setattr__(record, '_row', len(kept))
+                    kept.append(record)
+                data[:] = kept
+            seen = set()
+            for index in (*self.indexes[table_name].values(), *self.reverse_indexes[table_name].values()):
+                if id(index) in seen: # foreign keys share their hash index with the reverse one
+                    continue
+                seen.add(id(index))
+                for value, bucket in index.items():
+                    index[value] = {moved[row] for row in bucket} if type(bucket) is set else moved[bucket]
+            for index in self.range_indexes[table_name].values():
+                index.remap(moved)
+            dirty = self._dirty.get(table_name)
+            if dirty:
+                self._dirty[table_name] = {moved[row] for row in dirty}
+
+    def query(self, scql: str, **params):
+        ## runs one SCQL statement (see SCDB.md), &("name") placeholders come from params.
+        ## get returns a Cursor over the matching records (dicts for get: {...}),
+        ## update/remove the number of records changed and create the new record
+        return self._plan(scql).execute(self, params)
+
+    def filter(self, table_name: str, where: str, **params) -> Cursor:
+        ## records matching the inside of an SCQL where: block, eg.
+        ## db.filter("User", 'age > 30 and name startswith "A"'). on columnar tables with
+        ## numpy installed the conditions are evaluated over whole columns at once
+        if self.get_table(table_name) is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        return self._plan(f"get * from {table_name} where: {{{where}}}").execute(self, params)
+
+    def aggregate(self, table_name: str, group_by: Union[str, List[str], None] = None, metrics: Optional[Dict[str, tuple]] = None, where: Optional[str] = None, **params):
+        ## one pass aggregation, metrics is {name: (function, field)} with count, sum, min, max
+        ## or avg (count also takes "*"), where is the inside of an SCQL where: block.
+        ## db.aggregate("User", group_by="job", metrics={"total": ("count", "*"), "avgAge": ("avg", "age")})
+        ## gives a list with a dict per group, or just the one dict without group_by
+        if self.get_table(table_name) is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        from .scql import aggregate_query, plan
+        rows = plan(aggregate_query(table_name, group_by, metrics, where), self).execute(self, params).to_list()
+        return rows if group_by else rows[0]
+
+    def prepare(self, scql: str):
+        ## parses and plans once, then statement.execute(**params) runs it as often as needed
+        from .scql import Statement
+        return Statement(self, scql)
+
+    def _plan(self, scql: str):
+        plans = self._plans
+        cached = plans.get(scql)
+        if cached is not None:
+            plans.move_to_end(scql)
+            return cached
+        from .scql import parse, plan
+        cached = plans[scql] = plan(parse(scql), self)
+        if len(plans) > _PLAN_CACHE_SIZE:
+            plans.popitem(last=False)
+        return cached
+
+    def add_records(self, table_name: str, records: List[Table]) -> List[Table]:
+        with self._wal_batch():
+            return self._add_records(table_name, records)
+
+    def _add_records(self, table_name: str, records: List[Table]) -> List[Table]:
+        get = self._record_getter(table_name)
+        return [get(row) for row in self._insert_all(table_name, records)]
+
+    def _insert_all(self, table_name: str, records: List[Table]) -> List[int]:
+        range_indexes = self.range_indexes.get(table_name)
+        if not range_indexes:
+            return [self._insert(table_name, record, True) for record in records]
+        # sorted indexes get merged in one go at the end rather than one insert per record
+        rows = [self._insert(table_name, record, False) for record in records]
+        for key, index in range_indexes.items():
+            index.extend((getattr(record, key), row) for record, row in zip(records, rows))
+        return rows
+
+    def import_rows(self, table_name: str, rows: List[Dict[str, Any]], verify: bool = False) -> List[Table]:
+        ## bulk insert from plain dicts that already hold the right types (relations as raw ids),
+        ## skips validation like the binary loader does unless verify=True
+        table = self.get_table(table_name)
+        if table is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        from_trusted = table._from_trusted
+        return self.add_records(table_name, [from_trusted(row, verify) for row in rows])
+
+    ## index entries are the record's row number while a value is unique (the normal case
+    ## for primary keys) and only become a set of rows once shared
 
-        binary_data = b''
+    @staticmethod
+    def _index_add(index: Dict[Any, Any], value, row: int):
+        bucket = index.get(value)
+        if bucket is None:
+            index[value] = row
+        elif type(bucket) is set:
+            bucket.add(row)
+        elif bucket != row:
+            index[value] = {bucket, row}
+
+    @staticmethod
+    def _index_remove(index: Dict[Any, Any], value, row: int):
+        bucket = index.get(value)
+        if bucket is None:
+            return
+        if type(bucket) is set:
+            bucket.discard(row)
+            if len(bucket) == 1:
+                index[value] = next(iter(bucket))
+            elif not bucket:
+                del index[value]
+        elif bucket == row:
+            del index[value]
+
+    @staticmethod
+    def _index_rows(bucket) -> tuple:
+        # in row order, so an index lookup gives records back in the same order a scan would
+        if bucket is None:
+            return ()
+        return tuple(sorted(bucket)) if type(bucket) is set else (bucket,)
+
+    def _index_records(self, table_name: str, bucket) -> List[Table]:
+        return list(map(self._record_getter(table_name), self._index_rows(bucket)))
+
+    def _record_getter(self, table_name: str) -> Callable[[int], Table]:
+        # row number -> record, for turning what the indexes hold back into records
+        records = self.data[table_name]
+        return records.view if isinstance(records, ColumnStore) else records.__getitem__
+
+    def _update_indexes(self, record: Table, key: str, value):
+        # called from Table.__setattr__ before the new value is actually stored
+        table_name = record.__class__.__name__
+        if self._wal is not None:
+            self._log(_WriteAheadLog.UPDATE, table_name, record, (key, value))
+        row = record._row
+        self._dirty.setdefault(table_name, set()).add(row)
+        if key == record._pk:
+            # relation fields hold the record itself, so their reverse index entries move to the
+            # new pk with it. they also get saved as that pk, so the referrers count as changed
+            old = getattr(record, key)
+            for source_name, source_field_name in self._referencing_fields(table_name):
+                if not isinstance(self.tables[source_name]._fields[source_field_name], RelationField):
+                    continue
+                if self._pending:
+                    self._ensure_loaded(source_name)
+                reverse_index = self.reverse_indexes[source_name][source_field_name]
+                get = self._record_getter(source_name)
+                for referrer in self._index_rows(reverse_index.get(old)):
+                    if getattr(get(referrer), source_field_name) is record:
+                        self._index_remove(reverse_index, old, referrer)
+                        self._index_add(reverse_index, value, referrer)
+                        self._dirty.setdefault(source_name, set()).add(referrer)
+        index = self.indexes.get(table_name, {}).get(key)
+        if index is not None:
+            self._index_remove(index, getattr(record, key), row)
+            self._index_add(index, value, row)
+        range_index = self.range_indexes.get(table_name, {}).get(key)
+        if range_index is not None:
+            range_index.remove(getattr(record, key), row)
+            range_index.add(value, row)
+        field = self._reverse_fields.get(table_name, {}).get(key)
+        if field is not None:
+            reverse_index = self.reverse_indexes[table_name][key]
+            for target in self._reverse_keys(field, getattr(record, key)):
+                self._index_remove(reverse_index, target, row)
+            for target in self._reverse_keys(field, value):
+                self._index_add(reverse_index, target, row)
+            if isinstance(field, ManyToManyField):
+                relation_table_name = f"{table_name}_{field.to if isinstance(field.to, str) else field.to.__name__}"
+                self.relations[relation_table_name][record.id] = list(value or ())
+
+    @staticmethod
+    def _reverse_keys(field: Field, value) -> tuple:
+        # what a relation value points at, as target primary keys
+        if value is None:
+            return ()
+        if isinstance(field, ManyToManyField):
+            return tuple(value)
+        pk = value._pk # RelationField, holds the record itself
+        return (getattr(value, pk),) if pk is not None else ()
+
+    def referrers(self, table_name: str, pk, from_table: Optional[str] = None, field_name: Optional[str] = None) -> List[Table]:
+        ## every record pointing at table_name's record with this primary key through a
+        ## ForeignKeyField, ManyToManyField or RelationField, optionally only from one table
+        ## and/or field. reads the reverse indexes so it's proportional to the answer
+        if self.get_table(table_name) is None:
+            raise ValueError(f"Table {table_name} does not exist in the database")
+        found = []
+        for source_name, source_field_name in self._referencing_fields(table_name):
+            if (from_table is not None and source_name != from_table) or (field_name is not None and source_field_name != field_name):
+                continue
+            if self._pending:
+                self._ensure_loaded(source_name)
+            try:
+                bucket = self.reverse_indexes[source_name][source_field_name].get(pk)
+            except TypeError:
+                continue
+            found.extend(self._index_records(source_name, bucket))
+        return found
+
+    def _referencing_fields(self, table_name: str) -> List[tuple]:
+        # (table, field) for every relation field that points at table_name
+        return [
+            (source_name, key)
+            for source_name, source in self.tables.items()
+            for key, field in source._fields.items()
+            if isinstance(field, (ForeignKeyField, ManyToManyField, RelationField))
+            and (field.to if isinstance(field.to, str) else field.to.__name__) == table_name
+        ]
+    
+    ## write ahead log
+
+    def enable_wal(self, filename: str, checkpoint_bytes: Optional[int] = 16 << 20, checkpoint_interval: Optional[float] = None, fsync: bool = True):
+        ## from now on every insert/update/delete is appended to filename + ".wal" as it happens,
+        ## and load_from_file(filename) replays it on top of the snapshot. starts off with a
+        ## checkpoint so the file and the (empty) log match this database exactly.
+        ## checkpoints (snapshot + empty log) run in a background thread once the log passes
+        ## checkpoint_bytes and/or every checkpoint_interval seconds, or call checkpoint()
+        if self._wal is not None:
+            raise ValueError(f"Write ahead log already enabled for {self._wal_file}")
+        self._check_not_partial(filename)
+        for table_name, table in self.tables.items():
+            if table._pk is None:
+                raise ValueError(f"Table {table_name} has no primary key, the write ahead log needs one to replay changes")
+        self._wal = _WriteAheadLog(filename + ".wal", fsync)
+        self._wal_file = filename
+        self._checkpoint_bytes = checkpoint_bytes
+        self.checkpoint()
+        if checkpoint_bytes is not None or checkpoint_interval is not None:
+            self._checkpoint_wake.clear()
+            self._checkpoint_thread = threading.Thread(target=self._checkpoint_loop, args=(self._wal, checkpoint_interval), daemon=True)
+            self._checkpoint_thread.start()
+
+    def disable_wal(self, checkpoint: bool = True):
+        # stops logging, by default after folding what's logged into the file
+        wal = self._wal
+        if wal is None:
+            return
+        if checkpoint:
+            self.checkpoint()
+        self._wal = None
+        self._checkpoint_wake.set()
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+        wal.close()
+
+    def checkpoint(self):
+        ## writes a fresh snapshot of the whole database with the normal (atomic) binary save
+        ## and empties the log. the log lock is held throughout so nothing gets logged in between,
+        ## reads don't touch it and carry on as usual
+        wal = self._wal
+        if wal is None:
+            raise ValueError("Write ahead log isn't enabled")
+        with wal.lock:
+            # deletes wait on the lock, so once the tombstones are gone all() has nothing to
+            # compact (which takes the lock) until the snapshot is written
+            for table_name, dead in self._dead.items():
+                if dead:
+                    self._compact(table_name)
+            wal.flush()
+            self._save_binary(self._wal_file)
+            wal.truncate()
+
+    def _checkpoint_loop(self, wal: _WriteAheadLog, interval: Optional[float]):
+        while True:
+            self._checkpoint_wake.wait(interval)
+            self._checkpoint_wake.clear()
+            if self._wal is not wal:
+                return
+            if wal.size():
+                try:
+                    self.checkpoint()
+                except Exception as err: # keep going, the log still has everything
+                    self.checkpoint_error = err
+
+    def _log(self, op: int, table_name: str, record: Table, values=()):
+        wal = self._wal
+        wal.append(op, table_name, getattr(record, record._pk), values)
+        if self._checkpoint_bytes is not None and wal.size() >= self._checkpoint_bytes:
+            self._checkpoint_wake.set()
+
+    def _wal_batch(self):
+        return self._wal.batch() if self._wal is not None else nullcontext()
+
+    def _write_lock(self):
+        # held by every change from its log entry until it's applied (and by checkpoints), so a
+        # snapshot can't land in between, save the change and then throw away its log entry
+        return self._wal.lock if self._wal is not None else _NO_LOCK
+
+    def _replay_wal(self, path: str) -> int:
+        ## applies a log on top of what's loaded, returns how many entries there were
+        with open(path, 'rb') as file:
+            data = file.read()
+        count = 0
+        for op, table_name, pk, values in _WriteAheadLog.entries(data):
+            count += 1
+            table = self.get_table(table_name)
+            if table is None:
+                if self._partial_file is not None: # not loaded
+                    continue
+                raise ValueError(f"Write ahead log refers to table {table_name}, which the database doesn't have")
+            existing = [record for record in self._candidates(table_name, {table._pk: pk}) if getattr(record, table._pk) == pk]
+            if op == _WriteAheadLog.UPDATE:
+                field_name, value = values
+                field = table._fields.get(field_name)
+                if field is None: # a field a partial load left out
+                    continue
+                if isinstance(field, RelationField) and isinstance(value, tuple):
+                    value = self._pk_lookup(value[0])(value[1]) if value[0] in self.tables else None
+                for record in existing:
+                    setattr(record, field_name, value)
+                continue
+            if op == _WriteAheadLog.DELETE:
+                if existing:
+                    self._remove_records(table_name, existing)
+                continue
+            file_fields = self._file_fields.get(table_name, table._fields)
+            if len(values) != len(file_fields):
+                raise ValueError(f"Write ahead log entry for {table_name} doesn't match its fields")
+            row = {key: value for key, value in zip(file_fields, values) if key in table._fields}
+            for key, field in table._fields.items():
+                if isinstance(field, RelationField) and isinstance(row[key], tuple):
+                    row[key] = self._pk_lookup(row[key][0])(row[key][1]) if row[key][0] in self.tables else None
+            if existing:
+                # already in the snapshot (or logged twice), update it where it is so its row,
+                # the objects pointing at it and anyone holding on to it stay valid
+                for record in existing:
+                    for key, value in row.items():
+                        if getattr(record, key) != value:
+                            setattr(record, key, value)
+                continue
+            self._add_record(table_name, table._from_trusted(row), True)
+        return count
+
+    ## saving
+
+    def dirty_tables(self) -> List[str]:
+        # tables changed since the database was loaded or last saved
+        return list(self._dirty)
+
+    def dirty_records(self, table_name: str) -> List[Table]:
+        # records of table_name added or modified since then, deletes only show up in dirty_tables
+        get = self._record_getter(table_name)
+        return [get(row) for row in sorted(self._dirty.get(table_name, ()))]
+
+    def mark_dirty(self, record: Table):
+        ## for changes the database can't see, like a list field changed in place
+        ## (record.tags.append("x")) rather than assigned: counts the record as modified
+        ## and with the write ahead log on, logs it so the change survives a crash
+        table_name = record.__class__.__name__
+        if record._db is not self or record._row is None:
+            raise ValueError(f"{table_name} record isn't stored in this database")
+        with self._write_lock():
+            if self._wal is not None:
+                # as updates, so replaying them assigns into the record that's already there
+                with self._wal.batch():
+                    for key in record._fields:
+                        if key != record._pk:
+                            self._log(_WriteAheadLog.UPDATE, table_name, record, (key, getattr(record, key)))
+            self._dirty.setdefault(table_name, set()).add(record._row)
+
+    def _has_list_fields(self, table_name: str) -> bool:
+        return any(field.field_type is list for field in self.tables[table_name]._fields.values())
+
+    def serialize_to_binary(self) -> bytes:
+        out = io.BytesIO()
+        self._write_binary(out)
+        return out.getvalue()
+
+    def _write_binary(self, out, chunk_size: int = 1 << 16, source=None, reuse: Optional[Dict[str, tuple]] = None) -> Dict[str, tuple]:
+        ## everything goes through one bytearray which gets handed to out.write
+        ## whenever it grows past chunk_size, so this stays linear in the output size
+        ## (the old version did bytes += bytes which copied the whole thing every time)
+        ## tables in reuse (table -> (offset, length, record count)) get their block copied
+        ## from the source buffer as is. returns where every table's block ended up
+        buf = bytearray()
+        extend = buf.extend
+        pack_u32 = _U32.pack
+        write_string, write_value = _value_encoder(extend)
+
+        def flush():
+            if buf:
+                out.write(buf)
+                buf.clear()
+
+        extend(_MAGIC)
+        extend(bytes([_FORMAT_VERSION]))
+        schema_pos = out.tell() + len(buf)
 
         # enums
-        binary_data += struct.pack('!I', len(self.enums))
+        extend(pack_u32(len(self.enums)))
         for enum_name, enum in self.enums.items():
-            binary_data += encode_string(enum_name)
-            binary_data += encode_string(json.dumps(enum.values))
+            write_string(enum_name)
+            write_string(json.dumps(enum.values))
 
         # da tables (this took me too long to figure out)
-        binary_data += struct.pack('!I', len(self.tables))
+        extend(pack_u32(len(self.tables)))
         for table_name, table_class in self.tables.items():
-            binary_data += encode_string(table_name)
-            binary_data += struct.pack('!I', len(table_class._fields))
+            write_string(table_name)
+            extend(pack_u32(len(table_class._fields)))
             for field_name, field in table_class._fields.items():
-                binary_data += encode_string(field_name)
-                binary_data += encode_string(field.__class__.__name__)
+                write_string(field_name)
+                write_string(field.__class__.__name__)
                 if isinstance(field, RelationField):
-                    binary_data += encode_string(field.to if isinstance(field.to, str) else field.to.__name__)
-                    binary_data += encode_string(str(field.relation_type))
+                    write_string(field.to if isinstance(field.to, str) else field.to.__name__)
+                    write_string(str(field.relation_type))
                 elif isinstance(field, ArrayField):
-                    binary_data += encode_string(python_type_to_schema(field.item_type.__name__))
-                    binary_data += struct.pack('!I', field.max_length if field.max_length is not None else 0)
+                    write_string(python_type_to_schema(field.item_type.__name__))
+                    extend(pack_u32(field.max_length if field.max_length is not None else 0))
                 elif isinstance(field, ForeignKeyField):
-                    binary_data += encode_string(field.to if isinstance(field.to, str) else field.to.__name__)
+                    write_string(field.to if isinstance(field.to, str) else field.to.__name__)
                 elif isinstance(field, ManyToManyField):
-                    binary_data += encode_string(field.to if isinstance(field.to, str) else field.to.__name__)
+                    write_string(field.to if isinstance(field.to, str) else field.to.__name__)
                 elif isinstance(field, EnumField):
-                    binary_data += encode_string(field.enum.name)
-    
+                    write_string(field.enum.name)
+                attributes = _field_attributes(field)
+                if field_name in table_class._indexed and field_name != table_class._pk and not field.unique:
+                    attributes["index"] = True # also covers Meta.indexes so they survive a reload
+                if field_name in table_class._range_indexed:
+                    attributes["range_index"] = True
+                write_string(json.dumps(attributes))
+
         # cba to write a json converter for all the types
         # because that sucks
-        #ind = 1
-        binary_data += struct.pack('!I', len(self.data))
+        ## records are positional, in the same order as the fields in the schema above,
+        ## and each table's block is prefixed with its byte length so it can be skipped
+        blocks = {}
+        extend(pack_u32(len(self.data)))
         for table_name, records in self.data.items():
-            binary_data += encode_string(table_name)
-            binary_data += struct.pack('!I', len(records))
-            for record in records:
-                #print("s-at:", ind)
-                #ind += 1
-                binary_data += struct.pack('!I', len(record._fields))
-                for field_name, field in record._fields.items():
-                    binary_data += encode_string(field_name)
-                    value = getattr(record, field_name)
-                    binary_data += encode_value(value)
-
-        return binary_data
+            block = reuse.get(table_name) if reuse else None
+            if block is not None:
+                # not decoded if it's still waiting in a lazy load, it doesnt need to be
+                offset, length, count = block
+                write_string(table_name)
+                extend(pack_u32(count))
+                extend(_U64.pack(length))
+                flush()
+                blocks[table_name] = (out.tell(), length, count)
+                out.write(source[offset:offset + length])
+                continue
+            if self._pending:
+                self._ensure_loaded(table_name)
+            # deleted rows that haven't been compacted away yet are skipped rather than
+            # compacted here, a background checkpoint shouldnt be renumbering the indexes
+            dead = self._dead[table_name]
+            count = len(records) - len(dead)
+            write_string(table_name)
+            extend(pack_u32(count))
+            flush()
+            length_pos = out.tell()
+            out.write(_U64.pack(0)) # patched once the block is written
+            if isinstance(records, ColumnStore):
+                # straight off the columns, no views needed
+                rows = records.values()
+                if dead:
+                    rows = (values for row, values in enumerate(rows) if row not in dead)
+                for values in rows:
+                    for value in values:
+                        write_value(value)
+                    if len(buf) >= chunk_size:
+                        flush()
+            else:
+                field_names = list(self.tables[table_name]._fields)
+                for record in records:
+                    if record is None:
+                        continue
+                    for field_name in field_names:
+                        write_value(getattr(record, field_name))
+                    if len(buf) >= chunk_size:
+                        flush()
+            flush()
+            end_pos = out.tell()
+            out.seek(length_pos)
+            out.write(_U64.pack(end_pos - length_pos - 8))
+            out.seek(end_pos)
+            blocks[table_name] = (length_pos + 8, end_pos - length_pos - 8, count)
+
+        # footer, see the format notes at the top
+        footer_pos = out.tell() + len(buf) # buf isnt flushed yet when there are no tables
+        extend(pack_u32(len(blocks)))
+        for table_name, (offset, length, count) in blocks.items():
+            write_string(table_name)
+            extend(_U64.pack(offset))
+            extend(_U64.pack(length))
+            extend(pack_u32(count))
+        extend(_U64.pack(schema_pos))
+        extend(_U64.pack(footer_pos))
+        extend(_MAGIC)
+        flush()
+        return blocks
+
+    def _save_binary(self, filename: str):
+        ## atomic binary save that only encodes the tables changed since the last load/save,
+        ## every other table's block is copied byte for byte out of the file it's already in
+        if self._pending_file is not None and os.path.exists(filename) and os.path.samefile(filename, self._pending_file):
+            # a lazy load still has this file mapped and a mapped file can't be replaced
+            # (windows refuses), so decode what's left of it first, that lets go of the mapping
+            self._ensure_all_loaded()
+        dirty, self._dirty = self._dirty, {}
+        source = self._map_source()
+        blocks = {}
+        try:
+            if source is None:
+                self._write_atomic(filename, lambda file: blocks.update(self._write_binary(file)))
+            else:
+                # list values can be changed in place (record.tags.append(...)) without going through
+                # __setattr__, so a loaded table with list fields gets written out again every time
+                reuse = {
+                    table_name: block for table_name, block in self._blocks.items()
+                    if table_name not in dirty and (table_name in self._pending or not self._has_list_fields(table_name))
+                }
+
+                def write_reusing(file):
+                    try:
+                        with memoryview(source) as view:
+                            blocks.update(self._write_binary(file, source=view, reuse=reuse))
+                    finally:
+                        # done copying, closed before _write_atomic renames over the file for the same reason
+                        source.close()
+                self._write_atomic(filename, write_reusing)
+        except BaseException:
+            # nothing got saved so it all still counts as changed
+            for table_name, rows in dirty.items():
+                self._dirty.setdefault(table_name, set()).update(rows)
+            raise
+        finally:
+            if source is not None:
+                source.close()
+        self._blocks = blocks
+        self._source = (filename, self._file_signature(os.stat(filename)))
+
+    def _map_source(self):
+        # the file self._blocks point into, None if there isnt one or something else changed it since
+        if self._source is None or not self._blocks:
+            return None
+        path, signature = self._source
+        try:
+            with open(path, 'rb') as file:
+                if self._file_signature(os.fstat(file.fileno())) != signature:
+                    return None
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _file_signature(stat: os.stat_result) -> tuple:
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
 
     @classmethod
-    def deserialize_from_binary(cls, binary_data):
+    def deserialize_from_binary(cls, binary_data, lazy: bool = False, storage: str = "rows", verify: bool = False, tables: Optional[List[str]] = None, fields: Union[List[str], Dict[str, List[str]], None] = None) -> 'Database':
         ## after reading the documentation far too many times
         ## i still dont know what its doing entirely
         ## but hey we got binary encoding for data
-        import struct
-
-        def decode_string():
-            nonlocal index
-            length = struct.unpack('!I', binary_data[index:index+4])[0]
-            index += 4
-            string = binary_data[index:index+length].decode('utf-8')
-            index += length
-            return string
-
-        def decode_value():
-            nonlocal index
-            value_type = binary_data[index]
-            index += 1
-            if value_type == 0x01:
-                return decode_string()
-            elif value_type == 0x02:
-                value = struct.unpack('!q', binary_data[index:index+8])[0]
-                index += 8
-                return value
-            elif value_type == 0x03:
-                value = struct.unpack('!d', binary_data[index:index+8])[0]
-                index += 8
-                return value
-            elif value_type == 0x04:
-                value = struct.unpack('!?', binary_data[index:index+1])[0]
-                index += 1
-                return value
-            elif value_type == 0x05:
-                return None
-            elif value_type == 0x06:
-                table_name = decode_string()
-                obj_id = struct.unpack('!q', binary_data[index:index+8])[0]
-                index += 8
-                return (table_name, obj_id)
-            elif value_type == 0x07:
-                year, month, day = struct.unpack('!III', binary_data[index:index+12])
-                index += 12
-                return date(year, month, day)
-            elif value_type == 0x08:
-                hour, minute, second = struct.unpack('!III', binary_data[index:index+12])
-                index += 12
-                return time(hour, minute, second)
-            elif value_type == 0x09:
-                year, month, day, hour, minute, second = struct.unpack('!IIIIII', binary_data[index:index+24])
-                index += 24
-                return datetime(year, month, day, hour, minute, second)
-            elif value_type == 0x0A:
-                array_length = struct.unpack('!I', binary_data[index:index+4])[0]
-                index += 4
-                return [decode_value() for _ in range(array_length)]
-            elif value_type == 0x0B:
-                enum_name = decode_string()
-                enum_values = json.loads(decode_string())
-                return TableEnum(enum_name, enum_values)
-            else:
-                raise ValueError(f"Unsupported value type: {value_type}")
 
-        index = 0
-        db = cls()
+        ## with lazy=True table records are only skipped over here and get decoded
+        ## the first time the table is used (see _ensure_loaded)
+        ## records are built with Table._from_trusted, verify=True validates them like any other insert
+        ## tables/fields only load part of it, see load_from_file
+        reader = _BinaryReader(binary_data)
+        try:
+            return cls._read_binary(reader, lazy, storage, verify, tables, fields)
+        except BaseException:
+            # nothing keeps hold of the data then, so whatever it came from (a mmap) can be closed
+            reader.release()
+            raise
+
+    @classmethod
+    def _read_binary(cls, reader: '_BinaryReader', lazy: bool, storage: str, verify: bool, tables: Optional[List[str]], fields: Union[List[str], Dict[str, List[str]], None]) -> 'Database':
+        db = cls(storage=storage)
+        db._verify_loads = verify
+
+        reader.header()
+        directory = None
+        if reader.version >= 3:
+            directory, reader.pos = reader.footer()
 
         # enums
-        num_enums = struct.unpack('!I', binary_data[index:index+4])[0]
-        index += 4
+        num_enums = reader.u32()
         for _ in range(num_enums):
-            enum_name = decode_string()
-            enum_values = json.loads(decode_string()) 
+            enum_name = reader.string()
+            enum_values = json.loads(reader.string())
             db.add_enum(TableEnum(enum_name, enum_values))
 
         # tables
-        num_tables = struct.unpack('!I', binary_data[index:index+4])[0]
-        index += 4
+        num_tables = reader.u32()
         for _ in range(num_tables):
-            table_name = decode_string()
-            num_fields = struct.unpack('!I', binary_data[index:index+4])[0]
-            index += 4
-            fields = {}
+            table_name = reader.string()
+            num_fields = reader.u32()
+            table_fields = {}
             for _ in range(num_fields):
-                field_name = decode_string()
-                field_type = decode_string()
+                field_name = reader.string()
+                field_type = reader.string()
+                extra = {}
                 if field_type == 'RelationField':
-                    to = decode_string()
-                    relation_type = RelationType(decode_string())
-                    fields[field_name] = RelationField(to=to, relation_type=relation_type)
+                    to = reader.string()
+                    relation_type = RelationType(reader.string())
+                    extra = {"to": to, "relation_type": relation_type}
                 elif field_type == 'ArrayField':
-                    item_type_name = decode_string()
+                    item_type_name = reader.string()
                     item_type = getattr(__builtins__, item_type_name, None)
                     if item_type is None:
                         item_type = schema_type_to_python_type(item_type_name)
                     if item_type is None:
                         raise ValueError(f"Unknown type: {item_type_name}")
-                    max_length = struct.unpack('!I', binary_data[index:index+4])[0]
-                    index += 4
-                    fields[field_name] = ArrayField(item_type, max_length if max_length > 0 else None)
+                    max_length = reader.u32()
+                    extra = {"item_type": item_type, "max_length": max_length if max_length > 0 else None}
                 elif field_type == 'ForeignKeyField':
-                    to = decode_string()
-                    fields[field_name] = ForeignKeyField(to=to)
+                    extra = {"to": reader.string()}
                 elif field_type == 'ManyToManyField':
-                    to = decode_string()
-                    fields[field_name] = ManyToManyField(to=to)
+                    extra = {"to": reader.string()}
                 elif field_type == 'EnumField':
-                    enum_name = decode_string()
-                    enum = db.get_enum(enum_name)
-                    fields[field_name] = EnumField(enum)
-                else:
-                    field_class = globals()[field_type]
-                    fields[field_name] = field_class()
-            table_class = type(table_name, (Table,), fields)
+                    enum_name = reader.string()
+                    extra = {"enum": db.get_enum(enum_name)}
+                attributes = json.loads(reader.string()) if reader.version >= 2 else {}
+                field_class = globals()[field_type]
+                table_fields[field_name] = field_class(**extra, **attributes)
+            if tables is not None and table_name not in tables:
+                continue
+            wanted = fields.get(table_name) if isinstance(fields, dict) else fields
+            if wanted is not None:
+                if isinstance(fields, dict):
+                    unknown = [field_name for field_name in wanted if field_name not in table_fields]
+                    if unknown:
+                        raise ValueError(f"Table {table_name} has no field(s) {', '.join(unknown)}")
+                # the primary key always comes along, records are looked up and related by it
+                pk = next((key for key, field in table_fields.items() if field.primary_key), 'id')
+                projected = {key: field for key, field in table_fields.items() if key in wanted or key == pk}
+                if len(projected) < len(table_fields):
+                    db._file_fields[table_name] = list(table_fields)
+                    table_fields = projected
+            table_class = type(table_name, (Table,), table_fields)
             db.add_table(table_class)
-        
+        if tables is not None:
+            missing = [table_name for table_name in tables if table_name not in db.tables]
+            if missing:
+                raise ValueError(f"Database has no table(s) {', '.join(missing)}")
+        if isinstance(fields, dict):
+            missing = [table_name for table_name in fields if table_name not in db.tables]
+            if missing:
+                raise ValueError(f"Database has no table(s) {', '.join(missing)}")
+        elif fields is not None:
+            unknown = [field_name for field_name in fields if not any(field_name in table._fields for table in db.tables.values())]
+            if unknown:
+                raise ValueError(f"No loaded table has field(s) {', '.join(unknown)}")
+
         # data
-        num_data_tables = struct.unpack('!I', binary_data[index:index+4])[0]
-        index += 4
+        ## first pass only decodes rows and leaves references as the raw ids from the file,
+        ## they get resolved afterwards in _resolve_loaded_rows with one pk map per table
+        ## (used to be a db.get per reference which was quadratic and needed the
+        ## referenced table to already be loaded)
+        rows: Dict[str, List[Dict[str, Any]]] = {}
+        if directory is not None:
+            # every block is found through the footer, nothing in between gets touched
+            for table_name, (offset, length, num_records) in directory.items():
+                if table_name not in db.tables:
+                    continue
+                if table_name not in db._file_fields:
+                    db._blocks[table_name] = (offset, length, num_records)
+                if lazy:
+                    db._pending[table_name] = (reader, offset - 8, num_records)
+                else:
+                    reader.pos = offset
+                    rows[table_name] = db._decode_rows(reader, table_name, num_records)
+        num_data_tables = reader.u32() if directory is None else 0
         for _ in range(num_data_tables):
-            table_name = decode_string()
-            num_records = struct.unpack('!I', binary_data[index:index+4])[0]
-            index += 4
+            table_name = reader.string()
+            num_records = reader.u32()
+            if table_name not in db.tables: # left out of a partial load
+                reader.skip_rows(num_records)
+                continue
+            if reader.version >= 2 and table_name not in db._file_fields:
+                db._blocks[table_name] = (reader.pos + 8, _U64.unpack_from(reader.view, reader.pos)[0], num_records)
+            if lazy:
+                db._pending[table_name] = (reader, reader.pos, num_records)
+                reader.skip_rows(num_records)
+            elif reader.version >= 2:
+                reader.pos += 8 # block length, only needed when skipping
+                rows[table_name] = db._decode_rows(reader, table_name, num_records)
+            else:
+                rows[table_name] = db._decode_rows(reader, table_name, num_records)
+
+        # whatever was loaded matches the file, apart from references the loader had to drop
+        db._dirty = {}
+        if db._pending:
+            db._pending_reader = reader
+        else:
+            db._dirty = {table_name: set() for table_name in db._resolve_loaded_rows(rows)}
+            reader.release()
+        return db
+
+    def _decode_rows(self, reader: '_BinaryReader', table_name: str, num_records: int) -> List[Dict[str, Any]]:
+        fields = self.tables[table_name]._fields
+        file_fields = self._file_fields.get(table_name)
+        if reader.version >= 2 and file_fields is None:
+            field_names = list(fields)
+            read_value = reader.value
+            return [{field_name: read_value() for field_name in field_names} for _ in range(num_records)]
+        if reader.version >= 2:
+            # only some fields were asked for, the rest get stepped over without being decoded
+            steps = [(field_name, field_name in fields) for field_name in file_fields]
+            read_value = reader.value
+            skip_value = reader.skip_value
+            rows = []
             for _ in range(num_records):
-                num_fields = struct.unpack('!I', binary_data[index:index+4])[0]
-                index += 4
                 record_data = {}
-                for _ in range(num_fields):
-                    field_name = decode_string()
-                    value = decode_value()
-                    field = db.tables[table_name]._fields[field_name]
-                    if isinstance(field, DateTimeField) and isinstance(value, date):
-                        # TODO: fix time
-                        value = datetime.combine(value, time())
-                    elif isinstance(field, ForeignKeyField):
-                        related_table_name = field.to if isinstance(field.to, str) else field.to.__name__
-                        related_id = value
-                        value = db.get(related_table_name, id=related_id)
-                    elif isinstance(field, ManyToManyField):
-                        related_table_name = field.to if isinstance(field.to, str) else field.to.__name__
-                        value = [db.get(related_table_name, id=related_id) for related_id in value]
-                    record_data[field_name] = value
-                record = db.tables[table_name](**record_data)
-                db.add_record(table_name, record)
+                for field_name, wanted in steps:
+                    if wanted:
+                        record_data[field_name] = read_value()
+                    else:
+                        skip_value()
+                rows.append(record_data)
+            return rows
+        datetime_fields = {name for name, field in fields.items() if isinstance(field, DateTimeField)}
+        read_u32 = reader.u32
+        read_string = reader.string
+        read_value = reader.value
+        rows = []
+        for _ in range(num_records):
+            num_fields = read_u32()
+            record_data = {}
+            for _ in range(num_fields):
+                field_name = read_string()
+                if field_name not in fields:
+                    reader.skip_value()
+                    continue
+                value = read_value()
+                if field_name in datetime_fields and isinstance(value, date) and not isinstance(value, datetime):
+                    value = datetime.combine(value, time())
+                record_data[field_name] = value
+            rows.append(record_data)
+        return rows
+
+    def _ensure_loaded(self, table_name: str):
+        if table_name not in self._pending:
+            return
+        # every pending table this one's relations lead to (and theirs, and so on) gets decoded
+        # with it, so relations between them can resolve both ways in _resolve_loaded_rows
+        group = [table_name]
+        for name in group:
+            for field in self.tables[name]._fields.values():
+                if isinstance(field, (ForeignKeyField, ManyToManyField, RelationField)):
+                    target = field.to if isinstance(field.to, str) else field.to.__name__
+                    if target in self._pending and target not in group:
+                        group.append(target)
+        rows = {}
+        for name in group:
+            reader, position, num_records = self._pending.pop(name)
+            reader.pos = position + 8 if reader.version >= 2 else position
+            rows[name] = self._decode_rows(reader, name, num_records)
+        self._loading.update(group)
+        try:
+            for changed in self._resolve_loaded_rows(rows):
+                self._dirty.setdefault(changed, set())
+        finally:
+            self._loading.difference_update(group)
+        if not self._pending and self._pending_reader is not None:
+            # everything is decoded now so the file isnt needed anymore
+            self._pending_reader.release()
+            self._pending_reader = None
+            if self._pending_source is not None:
+                self._pending_source.close()
+                self._pending_source = None
+                self._pending_file = None
+
+    def _ensure_all_loaded(self):
+        for table_name in list(self._pending):
+            self._ensure_loaded(table_name)
+
+    def _resolve_loaded_rows(self, rows: Dict[str, List[Dict[str, Any]]]) -> set:
+        ## builds the decoded rows into records in two passes: every record goes in first with
+        ## its relation fields left empty, then those get filled in from pk -> row maps, so
+        ## relations within a table or around a cycle of tables resolve like any other.
+        ## returns the tables where a reference to something that doesnt exist got dropped
+        # pk -> raw row, enough to tell if a foreign key / many to many id still exists
+        row_maps: Dict[str, Optional[Dict[Any, Any]]] = {}
+        # pk -> row of the built record, relation fields hold the actual record so they need these
+        record_maps: Dict[str, Dict[Any, int]] = {}
+        # (table, row, field, target table, target pk) for the second pass
+        links = []
+        changed = set()
+        verify = self._verify_loads
+
+        def row_map(table_name):
+            if table_name not in row_maps:
+                table = self.tables.get(table_name)
+                pk = table._pk if table is not None else None
+                if pk is None:
+                    row_maps[table_name] = None
+                elif table_name in rows:
+                    row_maps[table_name] = {row.get(pk): row for row in rows[table_name]}
+                elif table_name in self._loading:
+                    row_maps[table_name] = None
+                else:
+                    # already loaded (or still waiting in a lazy load), its pk index has the ids
+                    self._ensure_loaded(table_name)
+                    row_maps[table_name] = self.indexes[table_name].get(pk)
+            return row_maps[table_name]
+
+        def lookup_record(table_name, pk_value):
+            if table_name in rows:
+                row = record_maps[table_name].get(pk_value)
+                return None if row is None else self._record_getter(table_name)(row)
+            table = self.tables.get(table_name)
+            if table is None or table._pk is None or table_name in self._loading:
+                return None
+            return self._get_one(table_name, **{table._pk: pk_value})
+
+        def build(table_name):
+            table_class = self.tables[table_name]
+            refs = []
+            for field_name, field in table_class._fields.items():
+                if isinstance(field, (ForeignKeyField, ManyToManyField, RelationField)):
+                    target = field.to if isinstance(field.to, str) else field.to.__name__
+                    refs.append((field_name, field, target))
+            relation_names = {field_name for field_name, field, _ in refs if isinstance(field, RelationField)}
+            # files written before bools had their own tag store them as ints
+            bool_fields = [field_name for field_name, field in table_class._fields.items() if isinstance(field, BooleanField)]
+            from_trusted = table_class._from_trusted
+            if verify and relation_names:
+                # relation fields are still empty here, they get checked once they're filled in
+                checks = [(key, check, default) for key, check, default in table_class._row_validators if key not in relation_names]
+                from_trusted = lambda row, verify: table_class._from_trusted(
+                    {**row, **{key: check(row.get(key, default)) for key, check, default in checks}})
+            records = []
+            unresolved = [] # (position in records, field, target table, target pk)
+            for row in rows.get(table_name, []):
+                for field_name, field, target in refs:
+                    value = row.get(field_name)
+                    if value is None:
+                        continue
+                    if isinstance(field, RelationField):
+                        unresolved.append((len(records), field_name, target, value[1]))
+                        row[field_name] = None
+                        continue
+                    existing = row_map(target)
+                    if existing is None: # no pk on the other table, nothing to check against
+                        continue
+                    if isinstance(field, ForeignKeyField):
+                        if value not in existing:
+                            row[field_name] = None
+                            changed.add(table_name)
+                    else:
+                        row[field_name] = [related_id for related_id in value if related_id in existing]
+                        if len(row[field_name]) != len(value):
+                            changed.add(table_name)
+                for field_name in bool_fields:
+                    value = row.get(field_name)
+                    if value is not None:
+                        row[field_name] = bool(value)
+                records.append(from_trusted(row, verify))
+            with self._wal_batch():
+                added = self._insert_all(table_name, records)
+            pk = table_class._pk
+            record_maps[table_name] = {getattr(record, pk): row for record, row in zip(records, added)} if pk else {}
+            links.extend((table_name, added[position], field_name, target, pk_value) for position, field_name, target, pk_value in unresolved)
+
+        for table_name in rows:
+            build(table_name)
+        for table_name, row, field_name, target, pk_value in links:
+            record = lookup_record(target, pk_value)
+            if verify:
+                record = self.tables[table_name]._validators[field_name](record)
+            if record is None:
+                if target in self.tables: # a partial load without the target table isnt dangling
+                    changed.add(table_name)
+                continue
+            # straight into the slot/column, the record is as it was saved and shouldnt count as changed
+            data = self.data[table_name]
+            if isinstance(data, ColumnStore):
+                data._set(field_name, row, record)
+            else:
+                object.__setattr__(data[row], field_name, record)
+            index = self.indexes[table_name].get(field_name)
+            if index is not None:
+                self._index_remove(index, None, row)
+                self._index_add(index, record, row)
+            self._index_add(self.reverse_indexes[table_name][field_name], pk_value, row)
+        return changed
 
-        return db
-    
     def to_json(self) -> str:
         schema = {}
         schema["enums"] = {name: enum.to_dict() for name, enum in self.enums.items()}
@@ -766,6 +2702,10 @@ class Database:
                     attributes.append("null: True")
                 if field.unique:
                     attributes.append("unique")
+                if field.index or (field_name in table._indexed and not field.primary_key and not field.unique and field_name != table._pk):
+                    attributes.append("index")
+                if field_name in table._range_indexed:
+                    attributes.append("rangeIndex")
                 if field.default is not None:
                     attributes.append(f"default: {repr(field.default)}")
                 if isinstance(field, StringField):
@@ -808,15 +2748,32 @@ class Database:
 
 
         if format == "binary" or format == "bin" or format == "scdb":
-            binary_data = self.serialize_to_binary()
+            self._check_not_partial(filename)
             if encryption_key:
+                # a fernet token covers the whole payload so this one cant be streamed
                 f = Fernet(encryption_key)
-                encrypted_data = f.encrypt(binary_data)
-                with open(filename, 'wb') as file:
-                    file.write(encrypted_data)
+                data = f.encrypt(self.serialize_to_binary())
+                save = lambda: self._write_atomic(filename, lambda file: file.write(data))
             else:
-                with open(filename, 'wb') as file:
-                    file.write(binary_data)
+                # records go straight to the file in chunks instead of building the whole thing first,
+                # and only for tables that changed since the last save (see _save_binary)
+                save = lambda: self._save_binary(filename)
+            if self._wal is not None and filename == self._wal_file:
+                with self._wal.lock:
+                    self._wal.flush()
+                    save()
+                    self._wal.truncate()
+            else:
+                save()
+                if os.path.exists(filename + ".wal"):
+                    # whatever was logged against the old file is in this snapshot (or overwritten by it)
+                    with open(filename + ".wal", 'r+b') as log:
+                        log.truncate()
+            if encryption_key:
+                # saved, but there's no copying blocks out of an encrypted file next time
+                self._dirty = {}
+                self._blocks = {}
+                self._source = None
         elif format == 'json':
             with open(filename, 'w') as f:
                 json.dump(json.loads(self.to_json()), f, indent=4)
@@ -827,16 +2784,188 @@ class Database:
             raise ValueError(f"Unsupported format: {format}")
 
     @classmethod
-    def load_from_file(cls, filename: str, encryption_key = None) -> 'Database':
+    def scan_file(cls, filename: str, table_name: str, where: Union[str, Callable[[Dict[str, Any]], bool], None] = None, fields: Optional[List[str]] = None, **params) -> Iterator[Table]:
+        ## streams one table's records out of a (unencrypted) binary file without loading it.
+        ## where is the inside of an SCQL where: block (&("name") comes from params) or a function
+        ## taking a {field: value} dict, and is checked on the values as they come out of the file:
+        ## only the fields it needs get decoded and only matching rows become records.
+        ## fields picks which fields the records have, like load_from_file (the pk always comes along).
+        ## nothing is resolved, relations are the raw ids from the file (RelationFields (table, pk))
+        ##   for user in Database.scan_file("db.scdb", "User", 'age > &("age")', age=30): ...
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        reader = None
+        try:
+            db = cls.deserialize_from_binary(data, lazy=True, tables=[table_name])
+            reader, db._pending_reader = db._pending_reader, None
+            table = db.tables[table_name]
+            file_fields = list(table._fields)
+            if fields is not None:
+                unknown = [field_name for field_name in fields if field_name not in table._fields]
+                if unknown:
+                    raise ValueError(f"Table {table_name} has no field(s) {', '.join(unknown)}")
+                table = type(table_name, (Table,), {key: field for key, field in table._fields.items() if key in fields or key == table._pk})
+            if isinstance(where, str):
+                from .scql import row_filter
+                tested, test = row_filter(db, table_name, where, params)
+            else:
+                tested, test = file_fields, where
+            pending = db._pending.pop(table_name, None)
+            if pending is None:
+                return
+            _, position, num_records = pending
+            from_trusted = table._from_trusted
+            # files written before bools had their own tag store them as ints, same fix up as a load
+            bool_fields = [field_name for field_name, field in db.tables[table_name]._fields.items() if isinstance(field, BooleanField)]
+
+            def fix_bools(row):
+                for field_name in bool_fields:
+                    value = row.get(field_name)
+                    if value is not None:
+                        row[field_name] = bool(value)
+                return row
+            if reader.version < 2:
+                # old files name every field per record, nothing to skip by position
+                reader.pos = position
+                for _ in range(num_records):
+                    row = db._decode_rows(reader, table_name, 1)[0]
+                    row = fix_bools({key: row.get(key, field.default) for key, field in db.tables[table_name]._fields.items()})
+                    if test is None or test(row):
+                        yield from_trusted(row)
+                return
+            reader.pos = position + 8
+            read_value = reader.value
+            skip_value = reader.skip_value
+            steps = [(field_name, field_name in table._fields) for field_name in file_fields]
+            tested = set(tested)
+            test_steps = [(field_name, field_name in tested) for field_name in file_fields]
+            # when the conditions already needed every field the record has, matches dont get read twice
+            complete = test is None or all(field_name in tested for field_name in table._fields)
+            for _ in range(num_records):
+                start = reader.pos
+                row = {}
+                for field_name, wanted in (steps if test is None else test_steps):
+                    if wanted:
+                        row[field_name] = read_value()
+                    else:
+                        skip_value()
+                fix_bools(row)
+                if test is not None and not test(row):
+                    continue
+                if not complete:
+                    end = reader.pos
+                    reader.pos = start
+                    row = {}
+                    for field_name, wanted in steps:
+                        if wanted:
+                            row[field_name] = read_value()
+                        else:
+                            skip_value()
+                    reader.pos = end
+                    fix_bools(row)
+                yield from_trusted(row)
+        finally:
+            if reader is not None:
+                reader.release()
+            data.close()
+
+    def _check_not_partial(self, filename: str):
+        if self._partial_file is not None and os.path.abspath(filename) == os.path.abspath(self._partial_file):
+            raise ValueError(f"Database was only partly loaded from {filename}, saving over it would lose everything that wasn't loaded")
+
+    @staticmethod
+    def _write_atomic(filename: str, write):
+        ## writes into a temp file next to the real one and swaps it in at the end,
+        ## so a crash or a full disk halfway through never leaves a half written db behind
+        tmp_path = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as file:
+                write(file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, filename)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # the rename itself only sticks once the directory is synced, checkpoints empty the log right after
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        except OSError: # windows can't open directories, renames there don't need it
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    @classmethod
+    def load_from_file(cls, filename: str, encryption_key = None, lazy: bool = False, storage: str = "rows", verify: bool = False, tables: Optional[List[str]] = None, fields: Union[List[str], Dict[str, List[str]], None] = None) -> 'Database':
+        ## lazy=True only reads the schema up front, each table's records are decoded
+        ## the first time something asks for that table (all/get/etc)
+        ## tables=["User"] only loads those tables, the others are skipped over in the file.
+        ## fields=["name"] (for every table) or {"User": ["name"]} only loads those fields
+        ## (plus the primary key), the table classes only have them and the other values
+        ## are never decoded. relations into tables that weren't loaded stay raw ids, or None
+        ## for RelationFields. a partly loaded database can't be saved back over its file
         name, ext = os.path.splitext(filename)
         if ext == ".bin" or ext == ".scdb":
             with open(filename, 'rb') as f:
-                data = f.read()
+                signature = cls._file_signature(os.fstat(f.fileno()))
+                if encryption_key:
+                    data = f.read()
+                else:
+                    try:
+                        # the mapping stays valid after the file is closed
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    except ValueError: # empty file, cant be mapped
+                        data = f.read()
             if encryption_key:
                 f = Fernet(encryption_key)
                 decrypted_data = f.decrypt(data)
             else:
                 decrypted_data = data
-            return cls.deserialize_from_binary(decrypted_data)
+            db = cls.deserialize_from_binary(decrypted_data, lazy=lazy, storage=storage, verify=verify, tables=tables, fields=fields)
+            if tables is not None or fields is not None:
+                db._partial_file = filename
+            if encryption_key:
+                db._blocks = {} # offsets into the decrypted data, not the file
+            else:
+                db._source = (filename, signature)
+            if isinstance(decrypted_data, mmap.mmap):
+                if db._pending:
+                    db._pending_source = decrypted_data
+                    db._pending_file = filename
+                else:
+                    decrypted_data.close()
+            if os.path.exists(filename + ".wal"):
+                # changes logged since the last snapshot (enable_wal)
+                db._replay_wal(filename + ".wal")
+            return db
         else:
-            raise ValueError(f"Invalid Database format to load from: {ext}")
\ No newline at end of file
+            raise ValueError(f"Invalid Database format to load from: {ext}")
+
+    @classmethod
+    def table_counts(cls, filename: str) -> Dict[str, int]:
+        ## how many records each table in a (unencrypted) binary file has, without decoding
+        ## any of them. for v3 files only the footer is read, older ones get lazy loaded
+        ## which walks the block headers. the .wal next to the file isn't counted
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = _BinaryReader(data)
+            try:
+                reader.header()
+                if reader.version >= 3:
+                    return {table_name: count for table_name, (_, _, count) in reader.footer()[0].items()}
+            finally:
+                reader.release()
+            db = cls.deserialize_from_binary(data, lazy=True)
+            counts = {table_name: len(records) for table_name, records in db.data.items()}
+            counts.update((table_name, pending[2]) for table_name, pending in db._pending.items())
+            if db._pending_reader is not None:
+                db._pending_reader.release()
+            return counts
+        finally:
+            data.close()
\ No newline at end of file
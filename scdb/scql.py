@@ -0,0 +1,1040 @@
+## SCQL - Super cool query language
+## parser -> planner -> executor for the statements written up in SCDB.md:
+##   get * from User where: {...} as: {order: Descending, orderBy: User.id} but: {limit = 10}
+##   get: {firstName, lastName} from User
+##   get: {job, total = count(*), avgAge = avg(age)} from User as: {groupBy: job}
+##   get * from Group include: {host, members}
+##   update User where: {...} with: {firstName = "Alex"}
+##   remove User where: {...} but: {onDelete = cascade}
+##   create User with: {firstName = "Steve", age = 34}
+## where blocks take ==, !=, <, <=, >, >=, in [...], startswith, and/or/not and parentheses,
+## a new line or comma between conditions means and.
+## values can be strings, numbers, True/False, null, Enum.Name.Member or &("param")
+
+import re
+import operator
+from datetime import date, time, datetime
+from array import array
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional
+
+from . import Table, Cursor, ColumnStore, Field, DateField, DateTimeField, TimeField, EnumField, ForeignKeyField, ManyToManyField, RelationField
+
+try:
+    import numpy as np
+except ImportError: # optional, without it where: blocks are checked record by record
+    np = None
+
+
+class SCQLError(ValueError):
+    pass
+
+
+_TOKEN = re.compile(r'''
+    (?P<space>[ \t\r]+)
+  | (?P<comment>\#[^\n]*)
+  | (?P<newline>\n)
+  | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<op>==|!=|<=|>=|<|>|=|&|\{|\}|\(|\)|\[|\]|,|:|\*|\.)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+''', re.VERBOSE)
+
+_ESCAPES = {'n': '\n', 't': '\t', '"': '"', "'": "'", '\\': '\\'}
+
+
+def _tokenize(text: str) -> List[tuple]:
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise SCQLError(f"Unexpected character {text[pos]!r} at {_location(text, pos)}")
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'string':
+            value = re.sub(r'\\(.)', lambda m: _ESCAPES.get(m.group(1), m.group(1)), value[1:-1])
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        if kind not in ('space', 'comment'):
+            tokens.append((kind, value, pos))
+        pos = match.end()
+    tokens.append(('end', None, len(text)))
+    return tokens
+
+
+def _location(text: str, pos: int) -> str:
+    line = text.count('\n', 0, pos) + 1
+    column = pos - (text.rfind('\n', 0, pos) + 1) + 1
+    return f"line {line}, column {column}"
+
+
+# ast
+
+class Literal:
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f"Literal({self.value!r})"
+
+class Param:
+    # &("name"), filled in when the query runs
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self):
+        return f"Param({self.name!r})"
+
+class EnumValue:
+    # Enum.Job.Teacher, resolved against the database when planning
+    def __init__(self, enum: str, member: str):
+        self.enum = enum
+        self.member = member
+
+    def __repr__(self):
+        return f"EnumValue({self.enum}.{self.member})"
+
+class ListValue:
+    def __init__(self, items: list):
+        self.items = items
+
+    def __repr__(self):
+        return f"ListValue({self.items!r})"
+
+class Compare:
+    def __init__(self, field: str, op: str, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return f"Compare({self.field} {self.op} {self.value!r})"
+
+class And:
+    def __init__(self, items: list):
+        self.items = items
+
+    def __repr__(self):
+        return f"And({self.items!r})"
+
+class Or:
+    def __init__(self, items: list):
+        self.items = items
+
+    def __repr__(self):
+        return f"Or({self.items!r})"
+
+class Not:
+    def __init__(self, item):
+        self.item = item
+
+    def __repr__(self):
+        return f"Not({self.item!r})"
+
+class Query:
+    def __init__(self, action: str, table: str):
+        self.action = action # get / update / remove / create
+        self.table = table
+        self.fields: Optional[List[str]] = None # get: {...}, None is *
+        self.where = None
+        self.order = "ascending"
+        self.order_by: Optional[str] = None
+        self.limit = None
+        self.values: Dict[str, Any] = {} # with: {...}
+        self.metrics: Dict[str, tuple] = {} # name = function(field) in get: {...}, field None for *
+        self.group_by: List[str] = []
+        self.include: List[str] = [] # relation fields to resolve into records
+        self.on_delete = "restrict" # remove only, see Database._delete_records
+
+    def __repr__(self):
+        return f"Query({self.action} {self.table}, fields={self.fields}, metrics={self.metrics}, group_by={self.group_by}, include={self.include}, where={self.where!r}, order_by={self.order_by} {self.order}, limit={self.limit!r}, values={self.values!r})"
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def error(self, message: str, token=None):
+        token = token or self.tokens[self.pos]
+        return SCQLError(f"{message} at {_location(self.text, token[2])}")
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def skip_newlines(self):
+        while self.tokens[self.pos][0] == 'newline':
+            self.pos += 1
+
+    def next(self):
+        self.skip_newlines()
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def at(self, value, kind=None) -> bool:
+        self.skip_newlines()
+        token = self.tokens[self.pos]
+        return token[1] == value and token[0] in ((kind,) if kind else ('op', 'name'))
+
+    def expect(self, value):
+        token = self.next()
+        if token[1] != value or token[0] not in ('op', 'name'):
+            raise self.error(f"Expected {value!r}, got {token[1]!r}", token)
+        return token
+
+    def name(self) -> str:
+        token = self.next()
+        if token[0] != 'name':
+            raise self.error(f"Expected a name, got {token[1]!r}", token)
+        return token[1]
+
+    def field(self) -> str:
+        # id or User.id
+        name = self.name()
+        while self.peek()[1] == '.':
+            self.pos += 1
+            name += '.' + self.name()
+        return name
+
+    def block(self, item):
+        # { item, item \n item }
+        self.expect('{')
+        while True:
+            self.skip_newlines()
+            while self.peek()[1] == ',':
+                self.pos += 1
+                self.skip_newlines()
+            if self.peek()[1] == '}':
+                self.pos += 1
+                return
+            item()
+            token = self.peek()
+            if token[0] != 'newline' and token[1] not in (',', '}'):
+                raise self.error(f"Expected ',' or a new line, got {token[1]!r}")
+
+    def parse(self) -> Query:
+        action_token = self.next()
+        action = action_token[1]
+        if action_token[0] != 'name' or action not in ('get', 'update', 'remove', 'create'):
+            raise self.error(f"Expected get, update, remove or create, got {action!r}", action_token)
+        if action == 'get':
+            if self.at('*'):
+                self.pos += 1
+                fields = None
+            else:
+                if self.at(':'):
+                    self.pos += 1
+                fields = []
+                metrics = {}
+                self.block(lambda: self.projection(fields, metrics))
+            self.expect('from')
+            query = Query(action, self.name())
+            query.fields = fields
+            if fields is not None:
+                query.metrics = metrics
+        else:
+            query = Query(action, self.name())
+
+        while not self.at(None, 'end'):
+            clause_token = self.next()
+            clause = clause_token[1]
+            if clause_token[0] != 'name' or clause not in ('where', 'as', 'with', 'but', 'include'):
+                raise self.error(f"Expected where, as, with, but or include, got {clause!r}", clause_token)
+            self.expect(':')
+            if clause == 'where':
+                query.where = self.conditions()
+            elif clause == 'as':
+                self.block(lambda: self.option(query))
+            elif clause == 'include':
+                self.block(lambda: query.include.append(self.field()))
+            elif clause == 'with':
+                self.block(lambda: self.assignment(query))
+            else:
+                self.block(lambda: self.modifier(query))
+        return query
+
+    def conditions(self):
+        # { condition, condition \n condition } -> one node, None when empty
+        conditions = []
+        self.block(lambda: conditions.append(self.expression()))
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else And(conditions)
+
+    def option(self, query: Query):
+        token = self.peek()
+        key = self.name()
+        self.expect(':')
+        if key == 'order':
+            order = self.name().lower()
+            if order not in ('ascending', 'descending'):
+                raise self.error(f"Unknown order {order!r}, use Ascending or Descending", token)
+            query.order = order
+        elif key == 'orderBy':
+            query.order_by = self.field()
+        elif key == 'groupBy':
+            if self.at('['):
+                self.pos += 1
+                while not self.at(']'):
+                    query.group_by.append(self.field())
+                    if not self.at(']'):
+                        self.expect(',')
+                self.pos += 1
+            else:
+                query.group_by.append(self.field())
+        else:
+            raise self.error(f"Unknown option {key!r}", token)
+
+    def projection(self, fields: List[str], metrics: Dict[str, tuple]):
+        # field, name = function(field) or function(field)
+        token = self.peek()
+        name = self.field()
+        function = None
+        if self.peek()[1] == '=':
+            self.pos += 1
+            token = self.peek()
+            function = self.name()
+        elif self.peek()[1] == '(':
+            function, name = name, None
+        if function is None:
+            fields.append(name)
+            return
+        if function not in AGGREGATES:
+            raise self.error(f"Unknown aggregate {function!r}, use one of {', '.join(AGGREGATES)}", token)
+        self.expect('(')
+        if self.at('*'):
+            self.pos += 1
+            if function != 'count':
+                raise self.error(f"{function}(*) doesn't mean anything, only count(*) does", token)
+            field = None
+        else:
+            field = self.field()
+        self.expect(')')
+        metrics[name or f"{function}({field or '*'})"] = (function, field)
+
+    def assignment(self, query: Query):
+        field = self.field()
+        self.expect('=')
+        query.values[field] = self.value()
+
+    def modifier(self, query: Query):
+        token = self.peek()
+        key = self.name()
+        if self.at(':'):
+            self.pos += 1
+        else:
+            self.expect('=')
+        if key == 'limit':
+            query.limit = self.value()
+        elif key == 'onDelete':
+            value_token = self.next()
+            if value_token[0] not in ('name', 'string') or value_token[1] not in ('restrict', 'cascade', 'set_null'):
+                raise self.error(f"onDelete has to be restrict, cascade or set_null, got {value_token[1]!r}", value_token)
+            query.on_delete = value_token[1]
+        else:
+            raise self.error(f"Unknown modifier {key!r}", token)
+
+    def expression(self):
+        items = [self.conjunction()]
+        while self.peek()[1] == 'or':
+            self.pos += 1
+            items.append(self.conjunction())
+        return items[0] if len(items) == 1 else Or(items)
+
+    def conjunction(self):
+        items = [self.negation()]
+        while self.peek()[1] == 'and':
+            self.pos += 1
+            items.append(self.negation())
+        return items[0] if len(items) == 1 else And(items)
+
+    def negation(self):
+        if self.at('not', 'name'):
+            self.pos += 1
+            return Not(self.negation())
+        if self.at('('):
+            self.pos += 1
+            expression = self.expression()
+            self.expect(')')
+            return expression
+        field = self.field()
+        token = self.next()
+        if token[1] == 'not' and self.at('in', 'name'):
+            self.pos += 1
+            return Not(Compare(field, 'in', self.value()))
+        if token[1] not in ('==', '!=', '<', '<=', '>', '>=', 'in', 'startswith'):
+            raise self.error(f"Expected a comparison, got {token[1]!r}", token)
+        return Compare(field, token[1], self.value())
+
+    def value(self):
+        token = self.next()
+        kind, value = token[0], token[1]
+        if kind in ('string', 'number'):
+            return Literal(value)
+        if kind == 'name':
+            if value in ('True', 'true'):
+                return Literal(True)
+            if value in ('False', 'false'):
+                return Literal(False)
+            if value in ('null', 'None'):
+                return Literal(None)
+            if value == 'Enum':
+                self.expect('.')
+                enum = self.name()
+                self.expect('.')
+                return EnumValue(enum, self.name())
+        if value == '&' and kind == 'op':
+            self.expect('(')
+            name_token = self.next()
+            if name_token[0] not in ('string', 'name'):
+                raise self.error("Expected a parameter name", name_token)
+            self.expect(')')
+            return Param(name_token[1])
+        if value == '[' and kind == 'op':
+            items = []
+            while not self.at(']'):
+                items.append(self.value())
+                if not self.at(']'):
+                    self.expect(',')
+            self.pos += 1
+            return ListValue(items)
+        raise self.error(f"Expected a value, got {value!r}", token)
+
+
+def parse(text: str) -> Query:
+    return _Parser(text).parse()
+
+
+def parse_where(text: str):
+    # just the inside of a where: block
+    parser = _Parser("{" + text + "}")
+    where = parser.conditions()
+    if not parser.at(None, 'end'):
+        raise parser.error("Unexpected text after the conditions")
+    return where
+
+
+def aggregate_query(table_name: str, group_by=None, metrics: Optional[Dict[str, tuple]] = None, where: Optional[str] = None) -> Query:
+    ## the Query behind Database.aggregate, same as
+    ## get: {group fields, name = function(field)...} from table where: {where} as: {groupBy: ...}
+    query = Query('get', table_name)
+    query.group_by = [group_by] if isinstance(group_by, str) else list(group_by or [])
+    query.fields = list(query.group_by)
+    for name, (function, field) in (metrics or {"count": ("count", "*")}).items():
+        if function not in AGGREGATES:
+            raise SCQLError(f"Unknown aggregate {function!r}, use one of {', '.join(AGGREGATES)}")
+        if field in ('*', None):
+            if function != 'count':
+                raise SCQLError(f"{function}(*) doesn't mean anything, only count(*) does")
+            field = None
+        query.metrics[name] = (function, field)
+    if where:
+        query.where = parse_where(where)
+    return query
+
+
+# planning
+
+def _coerce(field, value):
+    ## turns query values into what the field stores: enum member names, and dates/times
+    ## in either iso format or the ones the cli uses (DD-MM-YYYY, HH:MM:SS, DD-MM-YYYY|HH:MM:SS)
+    if isinstance(value, list):
+        return [_coerce(field, item) for item in value]
+    if not isinstance(value, str):
+        return value
+    if isinstance(field, EnumField):
+        return field.enum.values.get(value, value)
+    formats = ()
+    if isinstance(field, DateTimeField):
+        parse_iso, formats = datetime.fromisoformat, ("%d-%m-%Y|%H:%M:%S", "%d-%m-%Y")
+    elif isinstance(field, DateField):
+        parse_iso, formats = date.fromisoformat, ("%d-%m-%Y",)
+    elif isinstance(field, TimeField):
+        parse_iso = time.fromisoformat
+    else:
+        return value
+    try:
+        return parse_iso(value)
+    except ValueError:
+        pass
+    for format in formats:
+        try:
+            parsed = datetime.strptime(value, format)
+        except ValueError:
+            continue
+        return parsed if isinstance(field, DateTimeField) else parsed.date()
+    raise SCQLError(f"Invalid {field.field_type.__name__} value: {value!r}")
+
+
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
+
+_COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def _value_test(op: str):
+    # (stored value, query value) -> bool for one comparison
+    if op == 'in':
+        return lambda left, right: left in right
+    if op == 'startswith':
+        return lambda left, right: isinstance(left, str) and left.startswith(right)
+    compare = _COMPARISONS[op]
+    if op in ('==', '!='):
+        return compare
+
+    def ordered_test(left, right):
+        # None never compares as bigger or smaller than anything
+        if left is None or right is None:
+            return False
+        return compare(left, right)
+    return ordered_test
+
+
+def _sort_nulls_last(items: list, key, descending: bool) -> list:
+    present = [item for item in items if key(item) is not None]
+    present.sort(key=key, reverse=descending)
+    return present + [item for item in items if key(item) is None]
+
+
+def _finish_metric(function: str, count: int, value):
+    if function == 'count':
+        return count
+    if function == 'sum':
+        return value if value is not None else 0
+    if function == 'avg':
+        return value / count if count else None
+    return value
+
+
+def _aggregate_records(records: Iterable[Table], group_by: List[str], metrics: Dict[str, tuple]) -> List[dict]:
+    ## single pass hash aggregation: one [count, value] slot per metric per group.
+    ## nulls are skipped by everything but count(*)
+    specs = list(metrics.values())
+    groups: Dict[Any, list] = {}
+    single = group_by[0] if len(group_by) == 1 else None
+    for record in records:
+        if single is not None:
+            key = getattr(record, single)
+        else:
+            key = tuple(getattr(record, field_name) for field_name in group_by)
+        state = groups.get(key)
+        if state is None:
+            state = groups[key] = [[0, None] for _ in specs]
+        for slot, (function, field_name) in zip(state, specs):
+            if field_name is None:
+                slot[0] += 1
+                continue
+            value = getattr(record, field_name)
+            if value is None:
+                continue
+            slot[0] += 1
+            current = slot[1]
+            if function == 'count':
+                continue
+            if current is None:
+                slot[1] = value
+            elif function == 'sum' or function == 'avg':
+                slot[1] = current + value
+            elif function == 'min':
+                if value < current:
+                    slot[1] = value
+            elif value > current:
+                slot[1] = value
+    if not group_by and not groups:
+        groups[()] = [[0, None] for _ in specs]
+    rows = []
+    for key, state in groups.items():
+        row = {single: key} if single is not None else dict(zip(group_by, key))
+        for name, (function, _), (count, value) in zip(metrics, specs, state):
+            row[name] = _finish_metric(function, count, value)
+        rows.append(row)
+    return rows
+
+
+def _aggregate_indexes(db, table_name: str, group_by: List[str], metrics: Dict[str, tuple]) -> Optional[List[dict]]:
+    ## answers without touching the records when the indexes already know:
+    ## count(*) per value of a hash indexed field, count/min/max of a range indexed field
+    ## (the ends of the sorted keys). None when some metric needs a scan
+    records = db.all(table_name)
+    if group_by:
+        index = db.indexes[table_name].get(group_by[0])
+        if len(group_by) != 1 or index is None or any(spec != ('count', None) for spec in metrics.values()):
+            return None
+        rows = []
+        for value, bucket in index.items():
+            size = len(bucket) if type(bucket) is set else 1
+            rows.append({group_by[0]: value, **{name: size for name in metrics}})
+        return rows
+    ranged = db.range_indexes[table_name]
+    row = {}
+    for name, (function, field_name) in metrics.items():
+        if field_name is None:
+            row[name] = len(records)
+        elif field_name in ranged and function in ('count', 'min', 'max'):
+            keys = ranged[field_name].keys
+            if function == 'count':
+                row[name] = len(keys)
+            else:
+                row[name] = (keys[0] if function == 'min' else keys[-1]) if keys else None
+        else:
+            return None
+    return [row]
+
+
+# vectorized evaluation, for columnar tables when numpy is around
+
+_EXACT_FLOAT = 2 ** 53
+
+def _column_array(store: ColumnStore, name: str, field: Field):
+    ## a column as a numpy array, or None if it doesn't make sense as one.
+    ## typed array columns are wrapped without copying and never kept around (while numpy
+    ## holds their buffer they can't grow). list columns (numbers with nulls, dates) get
+    ## converted, and that's cached until the store changes
+    column = store.columns[name]
+    if isinstance(column, array):
+        return np.frombuffer(column, dtype=np.int64 if column.typecode == 'q' else np.float64)
+    cached = store._arrays.get(name)
+    if cached is not None and cached[0] == store.version:
+        return cached[1]
+    try:
+        if isinstance(field, DateTimeField):
+            converted = np.array(column, dtype='datetime64[us]') # None -> NaT
+        elif isinstance(field, DateField):
+            converted = np.array(column, dtype='datetime64[D]')
+        elif field.field_type in (int, float):
+            converted = np.array([np.nan if value is None else value for value in column], dtype=np.float64)
+            present = converted[~np.isnan(converted)]
+            if field.field_type is int and present.size and np.abs(present).max() >= _EXACT_FLOAT:
+                converted = None # would lose precision as floats
+        else:
+            converted = None
+    except (TypeError, ValueError, OverflowError):
+        converted = None
+    store._arrays[name] = (store.version, converted)
+    return converted
+
+
+def _array_value(values, value):
+    # query values in the same units as the column array
+    if values.dtype.kind == 'M':
+        unit = np.datetime_data(values.dtype)[0]
+        if isinstance(value, list):
+            return [np.datetime64(item, unit) if item is not None else None for item in value]
+        return np.datetime64(value, unit)
+    return value
+
+
+def _aggregate_arrays(store: ColumnStore, group_by: List[str], metrics: Dict[str, tuple], mask) -> Optional[List[dict]]:
+    ## aggregate with numpy: np.unique for the groups, bincount / ufunc.at per metric.
+    ## only for grouping on one integer column and numeric metrics, None otherwise
+    fields = store.table._fields
+    if len(group_by) > 1:
+        return None
+    if group_by:
+        keys = _column_array(store, group_by[0], fields[group_by[0]])
+        if keys is None or keys.dtype.kind != 'i':
+            return None
+        if mask is not None:
+            keys = keys[mask]
+        groups, inverse = np.unique(keys, return_inverse=True)
+        size = len(groups)
+    else:
+        inverse = np.zeros(len(store) if mask is None else int(mask.sum()), dtype=np.intp)
+        size = 1
+    results = {}
+    for name, (function, field_name) in metrics.items():
+        if field_name is None:
+            results[name] = np.bincount(inverse, minlength=size).tolist()
+            continue
+        field = fields[field_name]
+        values = _column_array(store, field_name, field)
+        if values is None or values.dtype.kind not in 'if':
+            return None
+        if mask is not None:
+            values = values[mask]
+        positions = inverse
+        if values.dtype.kind == 'f':
+            present = ~np.isnan(values)
+            if not present.all():
+                values = values[present]
+                positions = inverse[present]
+        counts = np.bincount(positions, minlength=size).tolist()
+        if function == 'count':
+            results[name] = counts
+            continue
+        if function in ('sum', 'avg'):
+            if values.dtype.kind == 'i':
+                totals = np.zeros(size, dtype=np.int64)
+                np.add.at(totals, positions, values)
+            else:
+                totals = np.bincount(positions, weights=values, minlength=size)
+        else:
+            start = np.inf if values.dtype.kind == 'f' else np.iinfo(np.int64).max
+            totals = np.full(size, start if function == 'min' else -start, dtype=values.dtype)
+            (np.minimum if function == 'min' else np.maximum).at(totals, positions, values)
+        # int fields with nulls were summed as floats, and empty groups still hold the start value
+        whole = int if field.field_type is int and function != 'avg' else (lambda total: total)
+        results[name] = [_finish_metric(function, count, whole(total) if count else None) for count, total in zip(counts, totals.tolist())]
+    if group_by:
+        rows = [{group_by[0]: group} for group in groups.tolist()]
+    else:
+        rows = [{}]
+    for name, column in results.items():
+        for row, value in zip(rows, column):
+            row[name] = value
+    return rows
+
+
+def _compare_mask(store: ColumnStore, name: str, field: Field, op: str, value):
+    column = store.columns[name]
+    count = len(store)
+    if value is None:
+        # only == and != mean anything against null
+        if op not in ('==', '!='):
+            return np.zeros(count, dtype=bool)
+        nulls = np.fromiter((item is None for item in column), dtype=bool, count=count) if isinstance(column, list) else np.zeros(count, dtype=bool)
+        return nulls if op == '==' else ~nulls
+    values = _column_array(store, name, field) if op != 'startswith' else None
+    if values is not None:
+        try:
+            if op == 'in':
+                present = [item for item in _array_value(values, value) if item is not None]
+                mask = np.isin(values, present)
+                if None in value and isinstance(column, list):
+                    mask |= np.fromiter((item is None for item in column), dtype=bool, count=count)
+            else:
+                mask = _COMPARISONS[op](values, _array_value(values, value))
+            if isinstance(mask, np.ndarray) and mask.shape == (count,):
+                return mask
+        except (TypeError, ValueError, OverflowError):
+            pass
+    # strings, bools, times... still one pass over the raw column, no record views
+    test = _value_test(op)
+    return np.fromiter((test(item, value) for item in column), dtype=bool, count=count)
+
+
+class Plan:
+    ## a query checked against one database: field names resolved, literals converted,
+    ## the predicate compiled into a function and an access path picked
+    ## access is one of:
+    ##   "hash"  - equality on hash indexed fields (Database._candidates picks the smallest)
+    ##   "range" - bounds on a range indexed field, comes out ordered by that field
+    ##   "ordered" - walks the range index of the orderBy field so a limit can stop early
+    ##   "scan"  - everything
+    def __init__(self, query: Query, db):
+        self.query = query
+        self.table_name = query.table
+        self.table = db.get_table(query.table)
+        if self.table is None:
+            raise SCQLError(f"Table {query.table} does not exist in the database")
+        self.params = set()
+        self.fields = [self.field_name(name) for name in query.fields] if query.fields is not None else None
+        self.metrics = {name: (function, self.field_name(field_name) if field_name else None) for name, (function, field_name) in query.metrics.items()}
+        self.group_by = [self.field_name(name) for name in query.group_by]
+        self.aggregating = bool(self.metrics or self.group_by)
+        if self.aggregating:
+            self.check_aggregates()
+        self.include = [self.field_name(name) for name in query.include]
+        for field_name in self.include:
+            if not isinstance(self.table._fields[field_name], (ForeignKeyField, ManyToManyField, RelationField)):
+                raise SCQLError(f"Can only include relation fields, {field_name} isn't one")
+        if self.include and (query.action != 'get' or self.aggregating):
+            raise SCQLError("include only works with plain get queries")
+        self.values = {self.field_name(name): self.getter(value, self.table._fields[self.field_name(name)], db) for name, value in query.values.items()}
+        self.predicate = self.compile(query.where, db) if query.where is not None else None
+        self.mask = self.compile_mask(query.where, db) if query.where is not None and np is not None and db.storage == "columnar" else None
+        self.descending = query.order == "descending"
+        self.order_by = None
+        self.group_order = None # orderBy for aggregates, applies to the result rows
+        if query.order_by and self.aggregating:
+            self.group_order = query.order_by if query.order_by in self.metrics else self.field_name(query.order_by)
+            if self.group_order not in self.metrics and self.group_order not in self.group_by:
+                raise SCQLError(f"Can only order aggregates by a groupBy field or an aggregate, not {query.order_by}")
+        elif query.order_by:
+            self.order_by = self.field_name(query.order_by)
+        self.limit = self.getter(query.limit, None, db) if query.limit is not None else None
+        self.access = "scan"
+        self.equals: Dict[str, Any] = {}
+        self.range_field = None
+        self.low = self.high = None
+        self.include_low = self.include_high = True
+        self.choose_access(query.where, db)
+        # no sort needed if the access path already walks the orderBy field
+        self.sorted = self.order_by is None or (self.access in ("range", "ordered") and self.range_field == self.order_by)
+
+    def check_aggregates(self):
+        if self.query.action != 'get':
+            raise SCQLError("Aggregates only work with get")
+        if not self.metrics:
+            raise SCQLError("groupBy needs at least one aggregate in get: {...}, like total = count(*)")
+        for field_name in self.fields:
+            if field_name not in self.group_by:
+                raise SCQLError(f"{field_name} has to be in groupBy to be used next to aggregates")
+        for field_name in self.group_by:
+            if self.table._fields[field_name].field_type is list:
+                raise SCQLError(f"Can't group by {field_name}, it's an array")
+        for function, field_name in self.metrics.values():
+            if function in ('sum', 'avg') and self.table._fields[field_name].field_type not in (int, float):
+                raise SCQLError(f"{function} needs a number field, {field_name} isn't one")
+
+    def field_name(self, name: str) -> str:
+        table_name, _, field_name = name.rpartition('.')
+        if table_name and table_name != self.table_name:
+            raise SCQLError(f"{name} is not a field of {self.table_name}")
+        if field_name not in self.table._fields:
+            raise SCQLError(f"Field {field_name} does not exist in table {self.table_name}")
+        return field_name
+
+    def getter(self, node, field, db):
+        # a function params -> value for a value node
+        if isinstance(node, Param):
+            self.params.add(node.name)
+            name = node.name
+            return lambda params: _coerce(field, params[name]) if field is not None else params[name]
+        if isinstance(node, ListValue):
+            getters = [self.getter(item, field, db) for item in node.items]
+            return lambda params: [get(params) for get in getters]
+        if isinstance(node, EnumValue):
+            enum = db.get_enum(node.enum)
+            if enum is None or node.member not in enum.values:
+                raise SCQLError(f"Enum.{node.enum}.{node.member} does not exist")
+            value = enum.values[node.member]
+        else:
+            value = _coerce(field, node.value) if field is not None else node.value
+        return lambda params: value
+
+    def compile(self, node, db, read=getattr):
+        # read(record, field name) gets a value out of whatever gets tested, records by default
+        if isinstance(node, And):
+            tests = [self.compile(item, db, read) for item in node.items]
+            return lambda record, params: all(test(record, params) for test in tests)
+        if isinstance(node, Or):
+            tests = [self.compile(item, db, read) for item in node.items]
+            return lambda record, params: any(test(record, params) for test in tests)
+        if isinstance(node, Not):
+            test = self.compile(node.item, db, read)
+            return lambda record, params: not test(record, params)
+        field_name = self.field_name(node.field)
+        node.field = field_name
+        get_value = self.getter(node.value, self.table._fields[field_name], db)
+        test = _value_test(node.op)
+        return lambda record, params: test(read(record, field_name), get_value(params))
+
+    def compile_mask(self, node, db):
+        # same as compile, but gives a function (store, params) -> numpy bool array over every row
+        if isinstance(node, (And, Or)):
+            masks = [self.compile_mask(item, db) for item in node.items]
+            combine = np.logical_and if isinstance(node, And) else np.logical_or
+
+            def combined(store, params):
+                mask = masks[0](store, params)
+                for other in masks[1:]:
+                    mask = combine(mask, other(store, params))
+                return mask
+            return combined
+        if isinstance(node, Not):
+            inner = self.compile_mask(node.item, db)
+            return lambda store, params: ~inner(store, params)
+        field_name = self.field_name(node.field)
+        field = self.table._fields[field_name]
+        get_value = self.getter(node.value, field, db)
+        op = node.op
+        return lambda store, params: _compare_mask(store, field_name, field, op, get_value(params))
+
+    def choose_access(self, where, db):
+        conditions = where.items if isinstance(where, And) else [where] if isinstance(where, Compare) else []
+        hashed = db.indexes[self.table_name]
+        ranged = db.range_indexes[self.table_name]
+        bounds: Dict[str, dict] = {}
+        for condition in conditions:
+            if not isinstance(condition, Compare) or isinstance(condition.value, ListValue):
+                continue
+            get_value = self.getter(condition.value, self.table._fields[condition.field], db)
+            if condition.op == '==' and condition.field in hashed:
+                self.equals[condition.field] = get_value
+            elif condition.field in ranged and condition.op in ('==', '<', '<=', '>', '>='):
+                field_bounds = bounds.setdefault(condition.field, {})
+                if condition.op in ('==', '>', '>=') and 'low' not in field_bounds:
+                    field_bounds['low'] = (get_value, condition.op != '>')
+                if condition.op in ('==', '<', '<=') and 'high' not in field_bounds:
+                    field_bounds['high'] = (get_value, condition.op != '<')
+        if self.equals:
+            self.access = "hash"
+        elif bounds:
+            # prefer bounding the orderBy field since then nothing needs sorting
+            self.range_field = self.order_by if self.order_by in bounds else next(iter(bounds))
+            field_bounds = bounds[self.range_field]
+            self.access = "range"
+            if 'low' in field_bounds:
+                self.low, self.include_low = field_bounds['low']
+            if 'high' in field_bounds:
+                self.high, self.include_high = field_bounds['high']
+        elif self.order_by in ranged:
+            self.access = "ordered"
+            self.range_field = self.order_by
+
+    def describe(self) -> str:
+        # short description for Cursor reprs
+        fields = "*" if self.fields is None else "{" + ", ".join(self.fields + list(self.metrics)) + "}"
+        return f"get {fields} from {self.table_name} ({self.access})"
+
+    def matches(self, db, params: Dict[str, Any]) -> Iterable[Table]:
+        # lazy unless the results need sorting
+        table_name = self.table_name
+        records = db.all(table_name) # also makes sure a lazily loaded table is decoded
+        if self.access == "hash":
+            records = db._candidates(table_name, {field_name: get(params) for field_name, get in self.equals.items()})
+        elif self.access == "range":
+            low = self.low(params) if self.low else None
+            high = self.high(params) if self.high else None
+            descending = self.descending and self.range_field == self.order_by
+            index = db.range_indexes[table_name][self.range_field]
+            if (self.low and low is None) or (self.high and high is None):
+                # compared with null, which the index would take as an open end. only the rows
+                # where the field is None can match (== null), the predicate sorts out the rest
+                rows = list(index.nulls)
+            else:
+                rows = index.range(low, high, self.include_low, self.include_high, descending)
+            records = map(db._record_getter(table_name), rows)
+        elif self.access == "ordered":
+            rows = db.range_indexes[table_name][self.range_field].ordered(self.descending)
+            records = map(db._record_getter(table_name), rows)
+        predicate = self.predicate
+        if self.mask is not None and self.access in ("scan", "ordered"):
+            # whole columns at once, hash/range lookups are already small enough not to bother
+            store = db.data[table_name]
+            mask = self.mask(store, params)
+            if self.access == "scan":
+                records = map(store.view, np.flatnonzero(mask).tolist())
+            else:
+                keep = mask.tolist()
+                records = map(store.view, (row for row in rows if keep[row]))
+        elif predicate is not None:
+            records = (record for record in records if predicate(record, params))
+        if not self.sorted:
+            order_by = self.order_by
+            records = _sort_nulls_last(list(records), lambda record: getattr(record, order_by), self.descending)
+        if self.limit is not None and not self.aggregating:
+            records = islice(records, self.limit(params))
+        return records
+
+    def joined(self, db, params: Dict[str, Any]) -> Iterable[dict]:
+        # rows as dicts with the included relation fields swapped for the records they point at.
+        # each related table's pk index is looked up once per id, no get per record
+        fields = list(self.table._fields) if self.fields is None else self.fields + [name for name in self.include if name not in self.fields]
+        resolvers = [(field_name, db._relation_resolver(self.table._fields[field_name])) for field_name in self.include]
+        for record in self.matches(db, params):
+            row = {field_name: getattr(record, field_name) for field_name in fields}
+            for field_name, resolve in resolvers:
+                row[field_name] = resolve(row[field_name])
+            yield row
+
+    def aggregate(self, db, params: Dict[str, Any]) -> List[dict]:
+        rows = None
+        if self.query.where is None:
+            rows = _aggregate_indexes(db, self.table_name, self.group_by, self.metrics)
+        if rows is None and np is not None and db.storage == "columnar" and (self.query.where is None or (self.mask is not None and self.access == "scan")):
+            store = db.all(self.table_name)
+            rows = _aggregate_arrays(store, self.group_by, self.metrics, self.mask(store, params) if self.mask is not None else None)
+        if rows is None:
+            rows = _aggregate_records(self.matches(db, params), self.group_by, self.metrics)
+        if self.group_order is not None:
+            group_order = self.group_order
+            rows = _sort_nulls_last(rows, lambda row: row[group_order], self.descending)
+        if self.limit is not None:
+            rows = rows[:self.limit(params)]
+        hidden = [field_name for field_name in self.group_by if field_name not in self.fields]
+        for row in rows:
+            for field_name in hidden:
+                del row[field_name]
+        return rows
+
+    def execute(self, db, params: Optional[Dict[str, Any]] = None):
+        params = params or {}
+        missing = self.params - set(params)
+        if missing:
+            raise SCQLError(f"Missing query parameters: {', '.join(sorted(missing))}")
+        action = self.query.action
+        if action == 'create':
+            values = {field_name: get(params) for field_name, get in self.values.items()}
+            return db.add_record(self.table_name, self.table(**values))
+        if action == 'get':
+            description = self.describe()
+            if self.aggregating:
+                return Cursor(lambda: self.aggregate(db, params), description=description)
+            if self.include:
+                return Cursor(lambda: self.joined(db, params), description=description)
+            if self.fields is None:
+                return Cursor(lambda: self.matches(db, params), description=description)
+            fields = self.fields
+            return Cursor(lambda: ({field_name: getattr(record, field_name) for field_name in fields} for record in self.matches(db, params)), description=description)
+        records = list(self.matches(db, params))
+        if action == 'update':
+            for record in records:
+                for field_name, get in self.values.items():
+                    setattr(record, field_name, get(params))
+            return len(records)
+        return db._delete_records(self.table_name, records, self.query.on_delete)
+
+
+def _where_fields(node, fields: List[str]) -> List[str]:
+    if isinstance(node, (And, Or)):
+        for item in node.items:
+            _where_fields(item, fields)
+    elif isinstance(node, Not):
+        _where_fields(node.item, fields)
+    elif node.field not in fields:
+        fields.append(node.field)
+    return fields
+
+
+def row_filter(db, table_name: str, where: str, params: Dict[str, Any]):
+    ## a where: block checked against {field: value} dicts instead of records, for
+    ## Database.scan_file. returns the fields the conditions look at and a row -> bool function
+    query = Query('get', table_name)
+    query.where = parse_where(where)
+    compiled = Plan(query, db)
+    missing = compiled.params - set(params)
+    if missing:
+        raise SCQLError(f"Missing query parameters: {', '.join(sorted(missing))}")
+    test = compiled.compile(query.where, db, operator.getitem)
+    return _where_fields(query.where, []), lambda row: test(row, params)
+
+
+def plan(query: Query, db) -> Plan:
+    if query.action in ('update', 'create') and not query.values:
+        raise SCQLError(f"{query.action} needs a with: block")
+    return Plan(query, db)
+
+
+class Statement:
+    ## a prepared query (Database.prepare), keeps its plan so running it
+    ## again skips tokenizing and planning. replans if tables or enums get added
+    def __init__(self, db, text: str):
+        self.db = db
+        self.text = text
+        self.plan = db._plan(text)
+        self.schema_version = db._schema_version
+
+    @property
+    def params(self) -> List[str]:
+        return sorted(self.plan.params)
+
+    def execute(self, **params):
+        db = self.db
+        if self.schema_version != db._schema_version:
+            self.plan = db._plan(self.text)
+            self.schema_version = db._schema_version
+        return self.plan.execute(db, params)
+
+    def __repr__(self):
+        return f"Statement({self.text!r})"
@@ -0,0 +1,44 @@
+from scdb import Database, Table, StringField, IntegerField
+
+db = Database()
+
+class User(Table):
+    id = IntegerField(primary_key=True)
+    name = StringField()
+    age = IntegerField(range_index=True)
+
+db.add_table(User)
+
+db.add_record("User", User(id=1, name="Alice", age=25))
+db.add_record("User", User(id=2, name="Bob", age=30))
+db.add_record("User", User(id=3, name="Carol", age=35))
+
+print(db.query('get * from User where: {id == 2}').to_list()) # get returns a lazy Cursor, this one uses the primary key index
+print(db.query('get: {name} from User where: {age >= 30} as: {order: Descending, orderBy: User.age}').to_list())
+print(db.query('get * from User where: {age < &("age")} but: {limit = 1}', age=40).to_list())
+
+by_id = db.prepare('get * from User where: {id == &("id")}') # parsed and planned once
+print(by_id.execute(id=3).to_list())
+
+print(db.filter("User", 'age > 26 and name startswith "B"').to_list()) # just the where: part
+
+print(db.query('get: {total = count(*), oldest = max(age)} from User').to_list())
+print(db.aggregate("User", metrics={"avgAge": ("avg", "age")}, where="age > 26"))
+
+print(db.query('update User where: {name == "Bob"} with: {age = 31}')) # returns how many changed
+print(db.query('create User with: {id = 4, name = "Dave", age = 20}'))
+print(db.query('remove User where: {age > 30}')) # returns how many were removed
+print(db.all("User"))
+
+## Output:
+# > [User(id = 2, name = Bob, age = 30)]
+# > [{'name': 'Carol'}, {'name': 'Bob'}]
+# > [User(id = 1, name = Alice, age = 25)]
+# > [User(id = 3, name = Carol, age = 35)]
+# > [User(id = 2, name = Bob, age = 30)]
+# > [{'total': 3, 'oldest': 35}]
+# > {'avgAge': 32.5}
+# > 1
+# > User(id = 4, name = Dave, age = 20)
+# > 2
+# > [User(id = 1, name = Alice, age = 25), User(id = 4, name = Dave, age = 20)]
@@ -0,0 +1,37 @@
+import os
+from scdb import Database, Table, StringField, IntegerField, ArrayField
+
+class User(Table):
+    id = IntegerField(primary_key=True)
+    username = StringField()
+    tags = ArrayField(item_type=str, default=[])
+
+db = Database()
+db.add_table(User)
+db.add_records("User", [User(id=1, username="first"), User(id=2, username="second")])
+
+db.enable_wal("testdata/wal.scdb", checkpoint_bytes=None) # no background checkpoints for this one
+
+db.add_record("User", User(id=3, username="third"))
+db.get("User", id=1).username = "renamed"
+db.delete("User", 2)
+print(os.path.getsize("testdata/wal.scdb.wal")) # just the three changes, the .scdb file wasn't touched
+
+# as if the process died here, the log is replayed on top of the last snapshot
+print(Database.load_from_file("testdata/wal.scdb").all("User"))
+
+# changed in place, the database only finds out through mark_dirty
+user = db.get("User", id=3)
+user.tags.append("new")
+db.mark_dirty(user)
+print(Database.load_from_file("testdata/wal.scdb").get("User", id=3).tags)
+
+db.checkpoint()
+print(os.path.getsize("testdata/wal.scdb.wal"))
+db.disable_wal()
+
+## Output:
+# > 130
+# > [User(id = 1, username = renamed, tags = []), User(id = 3, username = third, tags = [])]
+# > ['new']
+# > 0